@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# backfill.py
+"""Import historical QA data in shards using several worker processes."""
+# Copyright (c) 2015 Aditya Panchal
+
+import datetime
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import tempfile
+import time
+import multiprocessing
+import formschema
+import memorymonitor
+import progress
+import logging
+logger = logging.getLogger('qatrackimport.backfill')
+
+dtformat = "%Y%m%d"
+
+
+class ShardStore(object):
+    """Class that stores the backfill shards in a SQLite database so that
+       they can be leased by worker processes, or by hosts sharing the
+       database file."""
+    def __init__(self, filename, leasetime=600):
+
+        self.filename = filename
+        self.leasetime = leasetime
+        self.conn = sqlite3.connect(filename, timeout=60,
+                                    isolation_level=None)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS shards (
+                             id INTEGER PRIMARY KEY,
+                             machine TEXT, start TEXT, end TEXT,
+                             checkpoint TEXT, state TEXT DEFAULT 'pending',
+                             owner TEXT, expires REAL, error TEXT)""")
+
+    def close(self):
+        """Close the database connection."""
+
+        self.conn.close()
+
+    def add_shard(self, machine, start, end):
+        """Add a shard for the given machine and start / end progress."""
+
+        self.conn.execute(
+            "INSERT INTO shards (machine, start, end) VALUES (?, ?, ?)",
+            (machine, json.dumps(start), json.dumps(end)))
+
+    def get_machines(self):
+        """Return the ids of the machines that have shards."""
+
+        return [r[0] for r in self.conn.execute(
+            "SELECT DISTINCT machine FROM shards")]
+
+    def lease(self, owner):
+        """Lease the next pending or abandoned shard. Returns None if
+           there are no shards left to process."""
+
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.conn.execute(
+                """SELECT id, machine, start, end, checkpoint FROM shards
+                   WHERE state = 'pending'
+                   OR (state = 'leased' AND expires < ?)
+                   ORDER BY id LIMIT 1""", (now,)).fetchone()
+            if row is not None:
+                self.conn.execute(
+                    """UPDATE shards SET state = 'leased', owner = ?,
+                       expires = ? WHERE id = ?""",
+                    (owner, now + self.leasetime, row[0]))
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        return {'id': row[0], 'machine': row[1], 'start': json.loads(row[2]),
+                'end': json.loads(row[3]),
+                'checkpoint': None if row[4] is None else json.loads(row[4])}
+
+    def checkpoint(self, shardid, owner, checkpoint):
+        """Save the progress of a shard and renew its lease."""
+
+        c = self.conn.execute(
+            """UPDATE shards SET checkpoint = ?, expires = ?
+               WHERE id = ? AND owner = ? AND state = 'leased'""",
+            (json.dumps(checkpoint), time.time() + self.leasetime,
+             shardid, owner))
+        if c.rowcount != 1:
+            raise Exception("Lease of shard " + str(shardid) +
+                            " was lost. Another worker has taken over.")
+
+    def complete(self, shardid, owner):
+        """Mark a shard as done."""
+
+        self.conn.execute(
+            """UPDATE shards SET state = 'done', expires = NULL
+               WHERE id = ? AND owner = ?""", (shardid, owner))
+
+    def fail(self, shardid, owner, error):
+        """Mark a shard as failed so that it is not leased again."""
+
+        self.conn.execute(
+            """UPDATE shards SET state = 'failed', expires = NULL, error = ?
+               WHERE id = ? AND owner = ?""", (error, shardid, owner))
+
+    def release(self, shardid, owner):
+        """Make a leased shard available to other workers again, keeping
+           its checkpoint."""
+
+        self.conn.execute(
+            """UPDATE shards SET state = 'pending', owner = NULL,
+               expires = NULL WHERE id = ? AND owner = ?""", (shardid, owner))
+
+    def get_pending_count(self):
+        """Return the number of shards waiting to be leased."""
+
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM shards WHERE state = 'pending'"
+        ).fetchone()[0]
+
+    def retry_failed(self):
+        """Make the failed shards available to be leased again."""
+
+        self.conn.execute(
+            """UPDATE shards SET state = 'pending', error = NULL
+               WHERE state = 'failed'""")
+
+    def get_status(self):
+        """Return the number of shards in each state for each machine."""
+
+        status = {}
+        for machine, state, count in self.conn.execute(
+                """SELECT machine, state, COUNT(*) FROM shards
+                   GROUP BY machine, state"""):
+            status.setdefault(machine, {})[state] = count
+        return status
+
+    def get_completed_progress(self):
+        """Return the progress of the machines whose shards are all done,
+           as saved by the GUI in progress.json."""
+
+        progress = {}
+        for machine, status in self.get_status().items():
+            if list(status.keys()) != ['done']:
+                continue
+            row = self.conn.execute(
+                """SELECT checkpoint FROM shards
+                   WHERE machine = ? AND checkpoint IS NOT NULL
+                   ORDER BY id DESC LIMIT 1""", (machine,)).fetchone()
+            if row is not None:
+                progress[machine] = json.loads(row[0])
+        return progress
+
+
+def plan_shards(store, config, startdate=None, days=30, rows=500,
+                cache=False):
+    """Split the import of each configured machine into shards. Excel
+       machines are split by rows and MosaiQ machines by date ranges from
+       startdate until today. Machines already in the store are skipped."""
+
+    import ctdailyqasubmitter
+
+    existing = store.get_machines()
+    for m in config['machines']:
+        if m['id'] in existing:
+            logger.info("Shards already planned for: %s", m["name"])
+            continue
+        if m['type'] == "ct_daily_excel":
+            reader = ctdailyqasubmitter.CTDailyQASubmitter(m["file"])
+            reader.read_excel_file(
+                cache, config.get('excel_engine', 'openpyxl'))
+            start, end = reader.get_row_range(m.get('startrow'))
+            for s in range(start, end + 1, rows):
+                store.add_shard(m['id'], s, min(s + rows - 1, end))
+        elif m['type'] == "mosaiq_assessment":
+            s = datetime.datetime.strptime(
+                m.get('startdate', startdate), dtformat)
+            today = datetime.datetime.now()
+            while s <= today:
+                e = s + datetime.timedelta(days=days - 1)
+                store.add_shard(m['id'], s.strftime(dtformat),
+                                e.strftime(dtformat))
+                s = e + datetime.timedelta(days=1)
+        logger.info("Planned shards for: %s", m["name"])
+
+
+def run_shard(machine, shard, config, updatefunc, dryrun=False, cache=False,
+              schemacache=None, progressfunc=None, monitor=None, rc=None):
+    """Import a shard of a machine using the corresponding submitter,
+       resuming from the checkpoint of the shard if there is one. If a
+       memorymonitor.MemoryMonitor is given, the resident memory of the
+       read and submit stages is measured. rc is the RateController of
+       the worker (one is created for the shard if not given)."""
+
+    import ctdailyqasubmitter
+    import mqassessmentssubmitter
+    import ratecontroller
+
+    if monitor is None:
+        monitor = memorymonitor.MemoryMonitor()
+    qatcreds = config['qatrack_credentials']
+    if rc is None:
+        rc = ratecontroller.RateController.from_config(
+            config.get('rate_control', {}))
+    checkpoint = shard['checkpoint']
+
+    if machine['type'] == "ct_daily_excel":
+        # The last row may have been submitted before the shard was done
+        if checkpoint is not None and checkpoint > shard['end']:
+            return
+        with ctdailyqasubmitter.CTDailyQASubmitter(machine["file"]) as reader:
+            with monitor.stage('read'):
+                reader.read_excel_file(
+                    cache, config.get('excel_engine', 'openpyxl'))
+            reader.set_qatrack_server(
+                url=qatcreds['url'], username=qatcreds['username'],
+                password=qatcreds['password'], ratecontroller=rc,
+                schemacache=schemacache)
+            with monitor.stage('submit'):
+                reader.submit_data(
+                    startrow=shard['start'] if checkpoint is None
+                    else checkpoint, endrow=shard['end'],
+                    utc=machine['id'], progressfunc=progressfunc,
+                    updatefunc=updatefunc, dryrun=dryrun)
+    elif machine['type'] == "mosaiq_assessment":
+        mqcreds = config['mosaiq_credentials']
+        with mqassessmentssubmitter.MQAssessmentsSubmitter(
+                server=mqcreds['server'], username=mqcreds['username'],
+                password=mqcreds['password']) as reader:
+            reader.set_qatrack_server(
+                url=qatcreds['url'], username=qatcreds['username'],
+                password=qatcreds['password'], ratecontroller=rc,
+                schemacache=schemacache)
+            with monitor.stage('submit'):
+                reader.submit_data(
+                    viewid=machine['viewid'], startdate=shard['start'],
+                    enddate=shard['end'], patientid=machine.get('patientid'),
+                    utc=machine['id'], mapping=machine['mapping'],
+                    progressfunc=progressfunc, updatefunc=updatefunc,
+                    dryrun=dryrun, watermark=mqassessmentssubmitter.
+                    parse_watermark(checkpoint))
+
+
+def run_worker(storefile, config, dryrun=False, cache=False, workers=1):
+    """Lease and import shards until there are none left. If the worker
+       exceeds the memory_limit setting, the current shard is released
+       and the worker stops so that a new process can take over. Raises
+       MemoryLimitError if it is over the limit before it starts. The
+       rate_control limits are shared by the given number of workers.
+       Shards are checkpointed and completed in dry run mode as well, so
+       a dry run should use a copy of the store (as the command line
+       does)."""
+
+    import ratecontroller
+
+    # A worker that is over the limit before importing anything would only
+    # be replaced by another one, so it fails instead of leasing a shard
+    monitor = memorymonitor.MemoryMonitor.from_config(config)
+    monitor.check()
+
+    owner = socket.gethostname() + ":" + str(os.getpid())
+    # The rate controller keeps its state from one shard to the next
+    rc = ratecontroller.RateController.from_config(
+        config.get('rate_control', {}), share=workers)
+    store = ShardStore(storefile)
+    # Each worker keeps its own in-memory form schema cache
+    schemacache = formschema.SchemaCache() \
+        if config.get('validate_forms', False) else None
+    if schemacache is not None:
+        monitor.add_release(schemacache.loaded.clear)
+    # Log the progress of the worker every few seconds
+    bus = progress.ProgressBus(interval=5)
+    bus.subscribe(lambda event: logger.info(
+        "%s: %s", owner, progress.format_event(event)))
+    machines = dict((m['id'], m) for m in config['machines'])
+
+    while True:
+        shard = store.lease(owner)
+        if shard is None:
+            break
+        machine = machines[shard['machine']]
+        logger.info("%s: Importing %s from %s to %s", owner,
+                    machine["name"], shard['start'], shard['end'])
+
+        def updatefunc(utc, progress):
+            store.checkpoint(shard['id'], owner, progress)
+            monitor.check()
+
+        try:
+            run_shard(machine, shard, config, updatefunc, dryrun, cache,
+                      schemacache, bus, monitor, rc)
+        except memorymonitor.MemoryLimitError as e:
+            logger.warning("%s: %s. Stopping the worker.", owner, e)
+            store.release(shard['id'], owner)
+            break
+        except Exception as e:
+            logger.exception("%s: Shard %s failed", owner, shard['id'])
+            store.fail(shard['id'], owner, str(e))
+        else:
+            store.complete(shard['id'], owner)
+    monitor.report()
+    store.close()
+
+if __name__ == '__main__':
+
+    import sys
+    import argparse
+    import logging.handlers
+    logger = logging.getLogger('qatrackimport')
+    logger.setLevel(logging.INFO)
+    ch = logging.StreamHandler()
+    ch.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+    logger.addHandler(ch)
+
+    # Set up argparser to parse the command-line arguments
+    class DefaultParser(argparse.ArgumentParser):
+        def error(self, message):
+            sys.stderr.write('error: %s\n' % message)
+            self.print_help()
+            sys.exit(2)
+
+    parser = DefaultParser(
+        description="Import historical data of the configured machines " +
+        "in shards using several worker processes.")
+    parser.add_argument("config",
+                        help="Configuration (config.json) file")
+    parser.add_argument("-s", "--store",
+                        help="Shard store (SQLite) file",
+                        default="backfill.db")
+    parser.add_argument("-P", "--plan",
+                        help="Plan the shards of the configured machines",
+                        action="store_true")
+    parser.add_argument("-sd", "--startdate",
+                        help="Start date of the MosaiQ machines (YYYYMMDD)",
+                        default="20000101")
+    parser.add_argument("--days",
+                        help="Number of days per MosaiQ shard",
+                        type=int, default=30)
+    parser.add_argument("--rows",
+                        help="Number of rows per Excel shard",
+                        type=int, default=500)
+    parser.add_argument("-w", "--workers",
+                        help="Number of worker processes to run",
+                        type=int, default=0)
+    parser.add_argument("-r", "--retry",
+                        help="Retry the failed shards",
+                        action="store_true")
+    parser.add_argument("-p", "--progress",
+                        help="Update this progress file (progress.json) " +
+                        "for completed machines")
+    parser.add_argument("-c", "--cache",
+                        help="Cache the Excel file values in a sidecar file",
+                        action="store_true")
+    parser.add_argument("-d", "--debug",
+                        help="Show debug log",
+                        action="store_true")
+    parser.add_argument("-y", "--dryrun",
+                        help="Dry run mode (read data without submitting)",
+                        action="store_true")
+
+    # If there are no arguments, display help and exit
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+    args = parser.parse_args()
+
+    # Set debug logging if the debug flag is set
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+
+    with open(args.config) as c:
+        config = json.load(c)
+
+    # A dry run works on a copy of the store so that its checkpoints and
+    # completed shards don't keep the shards from being imported later
+    storefile = args.store
+    if args.dryrun:
+        fd, storefile = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        if os.path.exists(args.store):
+            shutil.copyfile(args.store, storefile)
+
+    store = ShardStore(storefile)
+    if args.plan:
+        plan_shards(store, config, args.startdate, args.days, args.rows,
+                    args.cache)
+    if args.retry:
+        store.retry_failed()
+
+    # Run the workers and wait for them to finish. Workers that stopped
+    # because of the memory limit are replaced while shards are left
+    def start_worker():
+        w = multiprocessing.Process(
+            target=run_worker,
+            args=(storefile, config, args.dryrun, args.cache,
+                  args.workers))
+        w.start()
+        return w
+
+    workers = [start_worker() for n in range(args.workers)]
+    while len(workers):
+        workers[0].join()
+        w = workers.pop(0)
+        if w.exitcode == 0 and len(workers) < args.workers and \
+                store.get_pending_count():
+            workers.append(start_worker())
+
+    for machine, status in sorted(store.get_status().items()):
+        logger.info("Machine %s: %s", machine, status)
+
+    # Save the progress of the completed machines for the GUI
+    if args.progress and not args.dryrun:
+        machineprogress = {}
+        if os.path.exists(args.progress):
+            with open(args.progress) as p:
+                machineprogress = json.load(p)
+        machineprogress.update(store.get_completed_progress())
+        with open(args.progress, 'w') as p:
+            json.dump(machineprogress, p)
+    store.close()
+    if args.dryrun:
+        os.remove(storefile)
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# benchmark.py
+"""Micro-benchmarks for the test result conversion and encoding functions."""
+# Copyright (c) 2015 Aditya Panchal
+
+import datetime
+import json
+import os
+import random
+import timeit
+import logging
+logger = logging.getLogger('qatrackimport.benchmark')
+
+# Number of synthetic rows used by each benchmark
+numrows = 1000
+
+
+def make_ct_rows(n, seed=0):
+    """Create synthetic CT Daily QA Excel rows (columns B to AE) covering
+       skipped rows and tests, multiple choice offsets, laser sign flips
+       and boolean tests."""
+
+    r = random.Random(seed)
+    rows = []
+    for i in range(n):
+        data = [datetime.datetime(2015, 1, 1) +
+                datetime.timedelta(days=i)]
+        data.append(r.choice(["AP", "JS", "No sims", None]))
+        data.extend(r.choice([None, 1, 2.5, 3.0, "4"]) for t in range(19))
+        data.extend([r.choice(['R', 'L', None]), r.choice([1.5, None]),
+                     r.choice(['P', 'A', None]), r.choice([2, None]),
+                     r.choice([0.5, None])])
+        data.extend(r.choice(['X', 'x', '', None]) for t in range(3))
+        data.append(r.choice(["Comment", None]))
+        rows.append(data)
+    return rows
+
+
+def make_mq_assessments(n, numtests=200, seed=0):
+    """Create synthetic MosaiQ observation sets for a large mapping of
+       boolean, float and string tests. Returns the mapping and a list of
+       (observations, date) tuples."""
+
+    r = random.Random(seed)
+    types = ["bool", "float"]
+    mapping = dict((str(20000 + t), [t, types[t % 2]])
+                   for t in range(numtests))
+    mapping.update({"19639": ["user", "str"],
+                    "19640": ["approval", "str"],
+                    "20269": ["comment", "str"]})
+    assessments = []
+    for i in range(n):
+        setid = 1000 + i
+        obs = []
+        for k, m in mapping.items():
+            # Leave some of the tests out so that they are skipped
+            if r.random() < 0.1:
+                continue
+            value = r.choice([0.0, 1.0]) if m[1] == "bool" else r.random()
+            obs.append((len(obs), setid, 1, int(k), value, "AP   "))
+        assessments.append(
+            (obs, datetime.datetime(2015, 1, 1) + datetime.timedelta(days=i)))
+    return mapping, assessments
+
+
+def get_benchmarks():
+    """Return a dict of benchmark names and (function, number of rows)
+       tuples. Each function converts or encodes the synthetic rows."""
+
+    import ctdailyqasubmitter
+    from mqassessmentssubmitter import MQAssessmentsSubmitter
+
+    ct = ctdailyqasubmitter.CTDailyQASubmitter(None)
+    ctrows = make_ct_rows(numrows)
+    payloads = [p for p in (ct.convert_test_result(data, n)
+                            for n, data in enumerate(ctrows))
+                if p is not None]
+    # Avoid connecting to the database since only the conversion is timed
+    mq = MQAssessmentsSubmitter.__new__(MQAssessmentsSubmitter)
+    mapping, assessments = make_mq_assessments(numrows // 10)
+
+    def ct_convert_test_result():
+        for n, data in enumerate(ctrows):
+            ct.convert_test_result(data, n)
+
+    def mq_convert_test_result():
+        for data, date in assessments:
+            mq.convert_test_result(data, mapping, date)
+
+    def payload_encode():
+        # Clear the encoded payload since it is only encoded once
+        for p in payloads:
+            p.encoded = None
+            p.encode("token")
+
+    return {
+        'ct_convert_test_result': (ct_convert_test_result, numrows),
+        'mq_convert_test_result': (mq_convert_test_result, numrows // 10),
+        'payload_encode': (payload_encode, len(payloads))
+    }
+
+
+def run_benchmarks(repeat=5, number=3, names=None, profile=None):
+    """Run the benchmarks and return the best time per row (in seconds)
+       for each benchmark. If profile is a filename prefix, a cProfile
+       pstats file is saved for each benchmark."""
+
+    # Silence the per-row logging of the converters during the benchmark
+    convloggers = [logging.getLogger('qatrackimport.ctdailyqasumbmitter'),
+                   logging.getLogger('qatrackimport.mqassessmentssubmitter')]
+    levels = [c.level for c in convloggers]
+    for c in convloggers:
+        c.setLevel(logging.WARNING)
+
+    results = {}
+    try:
+        for name, (func, rows) in sorted(get_benchmarks().items()):
+            if names and name not in names:
+                continue
+            times = timeit.repeat(func, repeat=repeat, number=number)
+            results[name] = min(times) / number / rows
+            logger.info("%s: %.2f us per row", name, results[name] * 1e6)
+            if profile:
+                import cProfile
+                pr = cProfile.Profile()
+                pr.runcall(func)
+                pr.dump_stats(profile + "." + name + ".pstats")
+    finally:
+        for c, level in zip(convloggers, levels):
+            c.setLevel(level)
+    return results
+
+
+def median(values):
+    """Return the median of a list of numbers."""
+
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def check_regressions(results, historyfile, threshold=0.1, save=True,
+                      recent=5):
+    """Compare the results to the median of the last recent results of
+       each benchmark in the history file, so that a single fast (or
+       slow) run doesn't skew the comparison. Returns a list of benchmark
+       names that are slower than the median by more than the threshold."""
+
+    history = []
+    if os.path.exists(historyfile):
+        with open(historyfile) as f:
+            history = json.load(f)
+
+    regressions = []
+    for name, t in sorted(results.items()):
+        previous = [h['results'][name] for h in history
+                    if name in h['results']][-recent:]
+        if not len(previous):
+            continue
+        baseline = median(previous)
+        if t > baseline * (1 + threshold):
+            logger.warning("%s is %.0f%% slower than the median of the "
+                           "last %d results", name,
+                           (t / baseline - 1) * 100, len(previous))
+            regressions.append(name)
+
+    if save:
+        history.append({
+            'date': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'results': results})
+        with open(historyfile, 'w') as f:
+            json.dump(history, f, indent=1)
+
+    return regressions
+
+if __name__ == '__main__':
+
+    import sys
+    import argparse
+    import logging.handlers
+    logger = logging.getLogger('qatrackimport')
+    logger.setLevel(logging.INFO)
+    ch = logging.StreamHandler()
+    ch.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+    logger.addHandler(ch)
+
+    # Set up argparser to parse the command-line arguments
+    class DefaultParser(argparse.ArgumentParser):
+        def error(self, message):
+            sys.stderr.write('error: %s\n' % message)
+            self.print_help()
+            sys.exit(2)
+
+    parser = DefaultParser(
+        description="Run the micro-benchmarks for the test result " +
+        "conversion functions.")
+    parser.add_argument("names", nargs="*",
+                        help="Names of the benchmarks to run (default: all)")
+    parser.add_argument("-r", "--repeat",
+                        help="Number of times to repeat each benchmark",
+                        type=int, default=5)
+    parser.add_argument("-H", "--history",
+                        help="JSON file to track the results over time",
+                        default="benchmark_history.json")
+    parser.add_argument("-t", "--threshold",
+                        help="Allowed slowdown relative to the median " +
+                        "of the recent results (default: 0.1 = 10%%)",
+                        type=float, default=0.1)
+    parser.add_argument("--recent",
+                        help="Number of recorded results to compare " +
+                        "against (default: 5)",
+                        type=int, default=5)
+    parser.add_argument("-n", "--nosave",
+                        help="Do not add the results to the history file",
+                        action="store_true")
+    parser.add_argument("-p", "--profile",
+                        help="Save cProfile stats to PROFILE.<name>.pstats")
+
+    args = parser.parse_args()
+
+    results = run_benchmarks(repeat=args.repeat, names=args.names,
+                             profile=args.profile)
+    regressions = check_regressions(results, args.history, args.threshold,
+                                    save=not args.nosave, recent=args.recent)
+
+    # Exit with an error code so that regressions can fail a build
+    sys.exit(1 if len(regressions) else 0)
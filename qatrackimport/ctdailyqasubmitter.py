@@ -5,8 +5,12 @@
 # Copyright (c) 2015 Aditya Panchal
 
 import resultssubmitter
+import payload
+import progress
+import workbookcache
+import xlsxreader
 import openpyxl
-import pprint
+import multiprocessing
 import logging
 logger = logging.getLogger('qatrackimport.ctdailyqasumbmitter')
 
@@ -14,39 +18,79 @@ logger = logging.getLogger('qatrackimport.ctdailyqasumbmitter')
 class CTDailyQASubmitter(object):
     """Class that reads the CT Daily QA test results from an Excel (.xlsx) file
        and submits them to QATrack+"""
+    # Row 55 is the first set of data with new procedure
+    firstrow = 55
+
     def __init__(self, filename):
 
         self.filename = filename
         self.url = "http://127.0.0.1:8080/"
         self.username = 'admin'
         self.password = 'admin'
+        self.ratecontroller = None
+        self.schemacache = None
+        self.snapshot = None
+        self.ws = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
-    def set_qatrack_server(self, url, username, password):
+    def close(self):
+        """Release the worksheet and the cached values of the Excel file."""
+
+        if self.ws is not None:
+            if hasattr(self.ws, 'close'):
+                self.ws.close()
+            else:
+                # The read-only workbook keeps the Excel file open
+                archive = getattr(self.ws.parent, '_archive', None)
+                if archive is not None:
+                    archive.close()
+            self.ws = None
+        self.snapshot = None
+
+    def set_qatrack_server(self, url, username, password,
+                           ratecontroller=None, schemacache=None):
         """Setup the QA Track+ server settings."""
 
         self.url = url
         self.username = username
         self.password = password
-
-    def read_excel_file(self):
-        """Read the CT Daily QA Excel file from disk."""
-
-        wb = openpyxl.load_workbook(filename=self.filename,
-                                    use_iterators=True,
-                                    data_only=True)
-        self.ws = wb.get_active_sheet()
-
-    def process_test(self, test, testnum, vartype):
-        """Process the test result to make sure it is valid. Otherwise
-           return a skipped test."""
-
-        if test is None:
-            return {"form-" + str(testnum) + "-skipped": "1"}
+        self.ratecontroller = ratecontroller
+        self.schemacache = schemacache
+
+    def read_excel_file(self, cache=False, engine='openpyxl'):
+        """Read the CT Daily QA Excel file from disk. If cache is True,
+           the cell values are loaded from (or saved to) a sidecar cache
+           file instead of parsing the workbook each time. engine is either
+           'openpyxl' or 'stream' (the faster xlsxreader.XLSXStreamReader)."""
+
+        self.close()
+        if cache:
+            self.snapshot = workbookcache.load(self.filename)
+            if self.snapshot is not None:
+                self.max_row = self.snapshot.max_row
+                return
+
+        if engine == 'stream':
+            self.ws = xlsxreader.XLSXStreamReader(self.filename)
         else:
-            return {"form-" + str(testnum) + "-value": vartype(test)}
+            wb = openpyxl.load_workbook(filename=self.filename,
+                                        use_iterators=True,
+                                        data_only=True)
+            self.ws = wb.get_active_sheet()
+        self.engine = engine
+        self.max_row = self.ws.max_row
+
+        if cache:
+            self.snapshot = workbookcache.save(
+                self.filename, self.iter_rows(1, self.max_row))
 
     def convert_test_result(self, data, row):
-        """Convert the test result into a dictonary compatible with the
+        """Convert the test result into a payload compatible with the
            QATrack+ UnitTestCollection."""
 
         # If no sims were performed, return None
@@ -54,107 +98,234 @@ class CTDailyQASubmitter(object):
             logger.info("Skipping Row # %s (no data)", row)
             return None
 
-        test_results = {
-            "work_started": data[0].replace(hour=6).strftime("%d-%m-%Y %H:%M"),
-            "work_completed": data[0].replace(
+        test_results = payload.TestResultsPayload(
+            work_started=data[0].replace(hour=6).strftime("%d-%m-%Y %H:%M"),
+            work_completed=data[0].replace(
                 hour=6, minute=30).strftime("%d-%m-%Y %H:%M"),
-            "status": 2,  # Approved status
-            "form-TOTAL_FORMS": "25",
-            "form-INITIAL_FORMS": "25",
-            "form-MAX_NUM_FORMS": "1000"
-        }
+            status=2,  # Approved status
+            total_forms="25")
+        test_results.resize(25)
 
         # Process tests 0-18 (numeric tests)
         for test in range(2, 21):
-            test_results.update(self.process_test(data[test], test - 2, float))
-
-        # Process tests 10 and 12 (multiple choice tests)
-        if "form-10-value" in test_results:
-            test_results["form-10-value"] = \
-                int(test_results["form-10-value"] - 1)
-        if "form-12-value" in test_results:
-            test_results["form-12-value"] = \
-                int(test_results["form-12-value"] - 2)
+            if data[test] is None:
+                test_results.set_skipped(test - 2)
+                continue
+            value = float(data[test])
+            # Process tests 10 and 12 (multiple choice tests)
+            if test == 12:
+                value = int(value - 1)
+            elif test == 14:
+                value = int(value - 2)
+            test_results.set_value(test - 2, value)
 
         # Process test 19 and 20 (laser / couch deviation tests)
         if not ((data[22] is None) or (data[21] is None)):
-            test_results["form-19-value"] = \
-                float(data[22]) * -1 if data[21] == 'R' else float(data[22])
+            test_results.set_value(
+                19, float(data[22]) * -1 if data[21] == 'R'
+                else float(data[22]))
         else:
-            test_results["form-19-skipped"] = "1"
+            test_results.set_skipped(19)
 
         # Process test 20 (laser / couch deviation test up/down)
         if not ((data[24] is None) or (data[23] is None)):
-            test_results["form-20-value"] = \
-                float(data[24]) * -1 if data[23] == 'P' else float(data[24])
+            test_results.set_value(
+                20, float(data[24]) * -1 if data[23] == 'P'
+                else float(data[24]))
         else:
-            test_results["form-20-skipped"] = "1"
+            test_results.set_skipped(20)
 
         # Process test 21 (couch test)
-        test_results.update(self.process_test(data[25], 21, float))
+        if data[25] is None:
+            test_results.set_skipped(21)
+        else:
+            test_results.set_value(21, float(data[25]))
 
         # Process tests 22-24 (boolean tests)
         for test in [26, 27, 28]:
-            test_results.update(self.process_test(data[test], test - 4, str))
-        for test in ["form-22-value", "form-23-value", "form-24-value"]:
-            if test in test_results:
-                test_results[test] = "1" \
-                    if test_results[test].upper() == "X" else "0"
+            if data[test] is None:
+                test_results.set_skipped(test - 4)
+            else:
+                test_results.set_value(
+                    test - 4, "1" if str(data[test]).upper() == "X" else "0")
 
         # Operator initials
         comment = "" if data[29] is None else data[29]
-        test_results["comment"] = "Performed by " + data[1] + \
+        test_results.comment = "Performed by " + data[1] + \
             "\nRow " + str(row) + "\n" + comment
 
-        logger.debug("Test Results: %s", pprint.pformat(test_results))
+        logger.debug("Test Results: %s", test_results)
 
         return test_results
 
-    def submit_data(self, startrow=None, endrow=None, utc=1,
-                    progressfunc=None, updatefunc=None, dryrun=False):
-        """Submit the test results to the QATrack+ server"""
+    def get_row_range(self, startrow=None, endrow=None):
+        """Return the first and last row of the data to be read."""
 
-        rs = resultssubmitter.ResultsSubmitter(
-            self.url, self.username, self.password)
+        start = self.firstrow if startrow is None else startrow
+        end = self.max_row if endrow is None else endrow
+        return start, end
 
-        # Row 55 is the first set of data with new procedure
-        start = 55 if startrow is None else startrow
-        end = self.ws.max_row if endrow is None else endrow
+    def iter_rows(self, startrow, endrow):
+        """Iterate over the cell values (columns B to AE) of the
+           selected rows."""
 
-        # Iterate over the selected rows
-        data_dimensions = 'B' + str(start) + ':AE' + str(end)
-        dims = end - start
-        rownum = start
+        data_dimensions = 'B' + str(startrow) + ':AE' + str(endrow)
         logger.info("Data dimensions: %s", data_dimensions)
-        for row in self.ws.iter_rows(data_dimensions):
+        if self.snapshot is not None:
+            for values in self.snapshot.iter_rows(startrow, endrow):
+                yield values
+        elif self.engine == 'stream':
+            for values in self.ws.iter_rows(startrow, endrow):
+                yield values
+        else:
+            for row in self.ws.iter_rows(data_dimensions):
+                yield [x.value for x in row]
+
+    def convert_rows(self, startrow, endrow):
+        """Read and convert the selected rows. Yields the row number and
+           the test results, or the exception if the row is invalid."""
+
+        rownum = startrow
+        for data in self.iter_rows(startrow, endrow):
             logger.info("Reading Row # %s", rownum)
-            data = [x.value for x in row]
             logger.debug("Data: %s %d", data, len(data))
             try:
                 test_results = self.convert_test_result(data, rownum)
-            except:
+            except Exception as e:
+                # The traceback is logged here since it is lost when the
+                # exception is sent back from a parse_workbooks process
+                logger.exception("Error on row %s. Please check data and "
+                                 "retry.", rownum)
+                yield rownum, e
+                return
+            yield rownum, test_results
+            rownum = rownum + 1
+
+    def submit_data(self, startrow=None, endrow=None, utc=1,
+                    progressfunc=None, updatefunc=None, dryrun=False,
+                    results=None):
+        """Submit the test results to the QATrack+ server. If results is
+           given, the already converted rows from parse_workbooks are
+           submitted instead of reading the rows from the worksheet.
+           progressfunc is either a function called with status messages
+           or a progress.ProgressBus."""
+
+        if results is None:
+            start, end = self.get_row_range(startrow, endrow)
+            results = self.convert_rows(start, end)
+        elif len(results):
+            start, end = results[0][0], results[-1][0]
+        else:
+            return
+
+        with resultssubmitter.ResultsSubmitter(
+                self.url, self.username, self.password,
+                ratecontroller=self.ratecontroller,
+                schemacache=self.schemacache) as rs:
+            self.submit_results(rs, results, start, end, utc, progressfunc,
+                                updatefunc, dryrun)
+
+    def submit_results(self, rs, results, start, end, utc,
+                       progressfunc=None, updatefunc=None, dryrun=False):
+        """Submit the converted rows using the given ResultsSubmitter."""
+
+        # Iterate over the selected rows
+        bus = progress.get_progress_bus(progressfunc)
+        bus.start(utc, end - start + 1)
+        for rownum, test_results in results:
+            if isinstance(test_results, Exception):
+                bus.error("Error on row " + str(rownum) + ": " +
+                          str(test_results))
                 if updatefunc:
                     updatefunc(utc, rownum)
-                raise
-                raise Exception("Error on row " + str(rownum) +
-                                ". Please check data and retry.")
-            else:
-                # Update the progress function
-                if progressfunc:
-                    progressfunc("Reading record: " + str(rownum-start) +
-                                 " of " + str(dims) + " [Row " +
-                                 str(rownum) + "]")
-                # If the test results aren't None, submit to server
+                raise test_results
+            # Update the progress
+            bus.update(rownum - start + 1, rownum)
+            # If the test results aren't None, submit to server
+            try:
                 if test_results and not dryrun:
                     logger.info("Submitting Row # %s to server", rownum)
                     text = rs.submit_data(utc, test_results)
                     with open("result.html", 'w') as f:
                         f.write(text)
+                elif test_results:
+                    rs.validate_data(utc, test_results)
+            except resultssubmitter.SubmissionError as e:
+                # Keep the rejected form to show why it was not accepted
+                with open("result.html", 'w') as f:
+                    f.write(e.text)
+                bus.error(e)
+                raise
+            except Exception as e:
+                bus.error(e)
+                raise
 
-            rownum = rownum + 1
             # Update the update function after the result has been submitted
             if updatefunc:
-                updatefunc(utc, rownum)
+                updatefunc(utc, rownum + 1)
+        bus.finish()
+
+
+def convert_shard(shard):
+    """Read and convert a range of rows of a CT Daily QA Excel file.
+       Used as the worker function of the process pool in parse_workbooks,
+       so only the converted test results are sent back to the parent."""
+
+    filename, startrow, endrow, cache, engine = shard
+    with CTDailyQASubmitter(filename) as reader:
+        reader.read_excel_file(cache, engine)
+        start, end = reader.get_row_range(startrow, endrow)
+        return list(reader.convert_rows(start, end))
+
+
+def parse_workbooks(jobs, processes=None, shardsize=2000, cache=False,
+                    engine='openpyxl'):
+    """Read and convert several CT Daily QA Excel files in a process pool,
+       one workbook per process. jobs is a list of (filename, startrow,
+       endrow) tuples. Returns a list of converted rows (as accepted by
+       CTDailyQASubmitter.submit_data) for each job. If cache is True, the
+       workbook cache files are used. engine selects the Excel reader (see
+       read_excel_file)."""
+
+    # A workbook is always read from its first row, so it is only split
+    # into row-range shards when it has a cache file that can be read
+    # from any row
+    shards = []
+    for jobnum, (filename, startrow, endrow) in enumerate(jobs):
+        snapshot = workbookcache.load(filename) if cache else None
+        if snapshot is None:
+            shards.append((jobnum, (filename, startrow, endrow, cache,
+                                    engine)))
+            continue
+        start = CTDailyQASubmitter.firstrow if startrow is None \
+            else startrow
+        end = snapshot.max_row if endrow is None else endrow
+        del snapshot
+        for s in range(start, end + 1, shardsize):
+            shardend = min(s + shardsize - 1, end)
+            shards.append((jobnum, (filename, s, shardend, cache, engine)))
+
+    # Only start the pool if there is more than one shard
+    if len(shards) > 1 and processes != 1:
+        pool = multiprocessing.Pool(
+            min(processes or multiprocessing.cpu_count(), len(shards)))
+        try:
+            converted = pool.map(convert_shard, [s[1] for s in shards])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        converted = [convert_shard(s[1]) for s in shards]
+
+    # Reassemble the shards of each job in row order, stopping at the
+    # first invalid row so that it is reported when submitting
+    results = [[] for j in jobs]
+    for (jobnum, shard), rows in zip(shards, converted):
+        if len(results[jobnum]) and \
+                isinstance(results[jobnum][-1][1], Exception):
+            continue
+        results[jobnum].extend(rows)
+    return results
 
 if __name__ == '__main__':
 
@@ -192,6 +363,15 @@ if __name__ == '__main__':
     parser.add_argument("-y", "--dryrun",
                         help="Dry run mode (read data without submitting)",
                         action="store_true")
+    parser.add_argument("-c", "--cache",
+                        help="Cache the Excel file values in a sidecar file",
+                        action="store_true")
+    parser.add_argument("--engine",
+                        help="Excel reader engine (openpyxl or stream)",
+                        choices=['openpyxl', 'stream'], default='openpyxl')
+    parser.add_argument("-j", "--processes",
+                        help="Number of processes used to read the file",
+                        type=int)
 
     # If there are no arguments, display help and exit
     if len(sys.argv) == 1:
@@ -203,7 +383,18 @@ if __name__ == '__main__':
     if args.debug:
         logger.setLevel(logging.DEBUG)
 
+    # Log the progress every few seconds
+    bus = progress.ProgressBus(interval=5)
+    bus.subscribe(lambda event: logger.info(progress.format_event(event)))
+
     # Read the CT Daily QA Excel file
-    reader = CTDailyQASubmitter(args.filename)
-    reader.read_excel_file()
-    reader.submit_data(args.startrow, args.endrow, dryrun=args.dryrun)
+    with CTDailyQASubmitter(args.filename) as reader:
+        if args.processes:
+            results = parse_workbooks(
+                [(args.filename, args.startrow, args.endrow)],
+                args.processes, cache=args.cache, engine=args.engine)[0]
+        else:
+            reader.read_excel_file(args.cache, args.engine)
+            results = None
+        reader.submit_data(args.startrow, args.endrow, progressfunc=bus,
+                           dryrun=args.dryrun, results=results)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# formschema.py
+"""Parse and cache the form schema of QATrack+ UnitTestCollections."""
+# Copyright (c) 2015 Aditya Panchal
+
+import json
+import os
+import re
+import time
+try:
+    from HTMLParser import HTMLParser
+except ImportError:
+    from html.parser import HTMLParser
+import logging
+logger = logging.getLogger('qatrackimport.formschema')
+
+formfield = re.compile(r'^form-(\d+)-(value|string_value)$')
+
+
+class SchemaValidationError(Exception):
+    """Raised when test results do not match the form schema."""
+    pass
+
+
+class PerformPageParser(HTMLParser):
+    """Parser that collects the test form fields of a perform page."""
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.total_forms = None
+        self.tests = {}
+        self.select = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        name = attrs.get('name') or ''
+        if name == 'form-TOTAL_FORMS':
+            self.total_forms = int(attrs.get('value'))
+            return
+        if tag == 'option' and self.select is not None:
+            self.tests[self.select][1].append(attrs.get('value'))
+            return
+        m = formfield.match(name)
+        if m is None:
+            return
+        n = int(m.group(1))
+        if m.group(2) == 'string_value':
+            self.tests.setdefault(n, ['string', None])
+        elif tag == 'select':
+            self.tests[n] = ['choice', []]
+            self.select = n
+        elif attrs.get('type') == 'radio':
+            self.tests[n] = ['boolean', None]
+        else:
+            self.tests.setdefault(n, ['numerical', None])
+
+    def handle_endtag(self, tag):
+        if tag == 'select':
+            self.select = None
+
+
+class FormSchema(object):
+    """Class that holds the number of forms, and the type and choices of
+       each test of a UnitTestCollection."""
+    def __init__(self, total_forms, tests):
+
+        self.total_forms = total_forms
+        self.tests = tests
+
+    @classmethod
+    def from_html(cls, html):
+        """Create a schema from the HTML of a UnitTestCollection perform
+           page."""
+
+        parser = PerformPageParser()
+        parser.feed(html)
+        if parser.total_forms is None:
+            raise Exception("Unable to find the test list form. " +
+                            "Please check the UnitTestCollection.")
+        return cls(parser.total_forms, parser.tests)
+
+    def validate(self, test_results):
+        """Check the test results (a dict or TestResultsPayload) against
+           the schema. Raises SchemaValidationError on a mismatch."""
+
+        errors = []
+        items = dict(test_results.items())
+        if str(items.get("form-TOTAL_FORMS")) != str(self.total_forms):
+            errors.append("expected " + str(self.total_forms) +
+                          " forms, got " + str(items.get("form-TOTAL_FORMS")))
+        for n in range(self.total_forms):
+            skipped = "form-" + str(n) + "-skipped" in items
+            key = "form-" + str(n) + "-value"
+            if key not in items:
+                if not skipped:
+                    errors.append("form " + str(n) + " has no value")
+                continue
+            value = items[key]
+            testtype, choices = self.tests.get(n, ['numerical', None])
+            try:
+                if testtype == 'numerical':
+                    float(value)
+                elif testtype == 'boolean' and str(value) not in ("0", "1"):
+                    raise ValueError
+                elif testtype == 'choice' and str(int(value)) not in choices:
+                    raise ValueError
+            except (TypeError, ValueError):
+                errors.append("form " + str(n) + " has an invalid " +
+                              testtype + " value: " + repr(value))
+        for key in items:
+            m = re.match(r'^form-(\d+)-', key)
+            if m and int(m.group(1)) >= self.total_forms:
+                errors.append(key + " is not part of the test list")
+
+        if len(errors):
+            raise SchemaValidationError("; ".join(errors))
+
+    def to_json(self):
+        """Return the schema as a JSON serializable dict."""
+
+        return {'total_forms': self.total_forms,
+                'tests': dict((str(n), t) for n, t in self.tests.items())}
+
+    @classmethod
+    def from_json(cls, data):
+        """Create a schema from a dict returned by to_json."""
+
+        return cls(data['total_forms'],
+                   dict((int(n), t) for n, t in data['tests'].items()))
+
+
+class SchemaCache(object):
+    """Class that caches the form schema of each UnitTestCollection, in
+       memory and optionally in a JSON file, for up to maxage seconds."""
+    def __init__(self, filename=None, maxage=86400):
+
+        self.filename = filename
+        self.maxage = maxage
+        self.schemas = {}
+        self.loaded = {}
+        if filename is not None and os.path.exists(filename):
+            try:
+                with open(filename) as f:
+                    self.schemas = json.load(f)
+            except ValueError:
+                logger.info("Ignoring invalid schema cache: %s", filename)
+
+    def get(self, utc, fetchfunc):
+        """Return the schema of the UnitTestCollection. fetchfunc is called
+           with the utc to get a new FormSchema if it is not cached."""
+
+        entry = self.schemas.get(str(utc))
+        if entry is not None and time.time() - entry['fetched'] < self.maxage:
+            if str(utc) not in self.loaded:
+                self.loaded[str(utc)] = FormSchema.from_json(entry['schema'])
+            return self.loaded[str(utc)]
+
+        logger.info("Fetching form schema for UTC %s", utc)
+        schema = fetchfunc(utc)
+        self.schemas[str(utc)] = {
+            'fetched': time.time(), 'schema': schema.to_json()}
+        self.loaded[str(utc)] = schema
+        self.save()
+        return schema
+
+    def invalidate(self, utc):
+        """Remove the schema of the UnitTestCollection from the cache."""
+
+        self.loaded.pop(str(utc), None)
+        if self.schemas.pop(str(utc), None) is not None:
+            logger.info("Invalidated form schema for UTC %s", utc)
+            self.save()
+
+    def save(self):
+        """Write the cache to disk if a filename was given."""
+
+        if self.filename is not None:
+            with open(self.filename, 'w') as f:
+                json.dump(self.schemas, f)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# memorymonitor.py
+"""Report and bound the resident memory of a long running import."""
+# Copyright (c) 2015 Aditya Panchal
+
+import contextlib
+import gc
+import os
+import sys
+import time
+import logging
+logger = logging.getLogger('qatrackimport.memorymonitor')
+
+
+class MemoryLimitError(Exception):
+    """Raised when the resident memory stays above the limit."""
+    pass
+
+
+def get_rss():
+    """Return the resident set size of the process in bytes, or None if
+       it cannot be determined on this platform."""
+
+    # Linux
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, AttributeError):
+        pass
+
+    # Windows
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD),
+                        ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t),
+                        ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t),
+                        ('PeakPagefileUsage', ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        if ctypes.windll.psapi.GetProcessMemoryInfo(
+                ctypes.windll.kernel32.GetCurrentProcess(),
+                ctypes.byref(counters), counters.cb):
+            return counters.WorkingSetSize
+        return None
+
+    # Other platforms only report the peak resident memory
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def format_size(size):
+    """Format a size in bytes in MB."""
+
+    return "n/a" if size is None else "%.1f MB" % (size / 1048576.0)
+
+
+class MemoryMonitor(object):
+    """Class that reports the resident memory used by each stage of an
+       import and bounds it to limit MB. When over the limit, check runs
+       the release callbacks and the garbage collector, and raises
+       MemoryLimitError if that was not enough so that the caller can
+       stop and let the process be restarted."""
+    def __init__(self, limit=None, interval=1.0):
+
+        self.limit = None if limit is None else limit * 1048576
+        self.interval = interval
+        self.releasefuncs = []
+        self.stages = {}
+        self.checked = 0
+        self.rss = get_rss()
+
+    @classmethod
+    def from_config(cls, config):
+        """Create a monitor from the top-level settings of config.json."""
+
+        return cls(limit=config.get('memory_limit'))
+
+    def add_release(self, func):
+        """Call func to release cached data when over the limit."""
+
+        if func not in self.releasefuncs:
+            self.releasefuncs.append(func)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Measure the resident memory before and after a stage of the
+           import. The peak and growth of each stage are kept in stages."""
+
+        start = get_rss()
+        try:
+            yield self
+        finally:
+            self.rss = get_rss()
+            s = self.stages.setdefault(
+                name, {'count': 0, 'peak': 0, 'growth': 0})
+            s['count'] += 1
+            s['peak'] = max(s['peak'], self.rss or 0)
+            if start is not None and self.rss is not None:
+                s['growth'] += self.rss - start
+            logger.debug("Stage %s: RSS %s (%+.1f MB)", name,
+                         format_size(self.rss),
+                         ((self.rss or 0) - (start or 0)) / 1048576.0)
+
+    def check(self):
+        """Check the resident memory. This is cheap enough to be called
+           for every row since it is sampled at most every interval
+           seconds. Returns the last sampled resident memory."""
+
+        now = time.time()
+        if now - self.checked < self.interval:
+            return self.rss
+        self.checked = now
+        self.rss = get_rss()
+        if self.limit is None or self.rss is None or self.rss <= self.limit:
+            return self.rss
+
+        logger.warning("Memory limit of %s exceeded: RSS %s",
+                       format_size(self.limit), format_size(self.rss))
+        for func in self.releasefuncs:
+            func()
+        gc.collect()
+        self.rss = get_rss()
+        if self.rss <= self.limit:
+            logger.info("Memory released: RSS %s", format_size(self.rss))
+            return self.rss
+        raise MemoryLimitError(
+            "Memory limit of " + format_size(self.limit) +
+            " exceeded: RSS " + format_size(self.rss))
+
+    def report(self):
+        """Log the resident memory used by each stage."""
+
+        logger.info("Resident memory: %s", format_size(get_rss()))
+        for name, s in sorted(self.stages.items()):
+            logger.info("Stage %s: %d runs, peak %s, growth %s", name,
+                        s['count'], format_size(s['peak']),
+                        format_size(s['growth']))
@@ -5,19 +5,24 @@
 # Copyright (c) 2015 Aditya Panchal
 
 import resultssubmitter
+import payload
+import progress
 import datetime
 import pymssql
-from operator import itemgetter
 import pprint
 import logging
 logger = logging.getLogger('qatrackimport.mqassessmentssubmitter')
 
 dtformat = "%Y%m%d"
+watermarkformat = "%Y-%m-%d %H:%M:%S.%f"
 
 
 class MQAssessmentsSubmitter(object):
     """Class that reads assessments from the MosaiQ DB and
        submits them to QATrack+"""
+    # Mapping last used by convert_test_result and its compiled form
+    compiledmapping = (None, None)
+
     def __init__(self, server=None, username=None, password=None):
 
         self.server = server
@@ -26,16 +31,27 @@ class MQAssessmentsSubmitter(object):
         self.qat_url = "http://127.0.0.1:8080/"
         self.qat_username = 'admin'
         self.qat_password = 'admin'
+        self.ratecontroller = None
+        self.schemacache = None
 
         # Connect to the MosaiQ database
         self.connect_to_database()
 
-    def set_qatrack_server(self, url, username, password):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.disconnect_from_database()
+
+    def set_qatrack_server(self, url, username, password,
+                           ratecontroller=None, schemacache=None):
         """Setup the QA Track+ server settings."""
 
         self.qat_url = url
         self.qat_username = username
         self.qat_password = password
+        self.ratecontroller = ratecontroller
+        self.schemacache = schemacache
 
     def connect_to_database(self):
         """Connect to the MosaiQ database."""
@@ -48,31 +64,45 @@ class MQAssessmentsSubmitter(object):
     def disconnect_from_database(self):
         """Disconnect from the the MosaiQ database."""
 
-        self.conn.close()
+        if self.conn is not None:
+            self.cursor.close()
+            self.conn.close()
+            self.conn = self.cursor = None
 
     def get_mosaiq_obsreq(self, viewid, startdate=None, enddate=None,
-                          patientid=None):
+                          patientid=None, watermark=None):
         """Get a list of MosaiQ ObsReq instances for the given
-           observation view definition."""
+           observation view definition. If a watermark (Create_DtTm,
+           OBR_Set_ID) is given, only instances created after it are
+           returned."""
 
         startdate = "19010101" if startdate is None else startdate
-        # Query from startdate to enddate + 1 since endtime is set to midnight
+        # Query from startdate to enddate + 1 since endtime is set to midnight.
+        # The range is half-open so that consecutive date ranges (i.e. the
+        # backfill shards) don't both include an assessment at midnight
         query = """SELECT OBR_Set_ID, Create_DtTm FROM ObsReq
                    WHERE VIEW_OBD_ID LIKE %s
                    AND Create_DtTm >= CONVERT(datetime, %d)
                    """
+        params = [viewid, startdate]
         if enddate is not None:
             query += \
-                """AND Create_DtTm <= DATEADD(day, 1, CONVERT(datetime, %d))"""
+                """AND Create_DtTm < DATEADD(day, 1, CONVERT(datetime, %d))"""
+            params.append(enddate)
+        # Keyset condition written so that the Create_DtTm index can be used
+        if watermark is not None:
+            query += """ AND Create_DtTm >= %s
+                         AND (Create_DtTm > %s OR OBR_Set_ID > %d)"""
+            params.extend([watermark[0], watermark[0], watermark[1]])
 
         if patientid is not None:
             query = query + " AND Pat_ID1 LIKE " + str(patientid)
-        query = query + ";"
-        logger.debug("Start date: %s End date: %s", startdate, enddate)
+        query = query + " ORDER BY Create_DtTm, OBR_Set_ID;"
+        logger.debug("Start date: %s End date: %s Watermark: %s",
+                     startdate, enddate, watermark)
         logger.debug("Obsreq Query: %s", query)
-        self.cursor.execute(query, (viewid, startdate, enddate))
-        obsreqs = list(self.cursor.fetchall())
-        return sorted(obsreqs, key=itemgetter(1))
+        self.cursor.execute(query, tuple(params))
+        return list(self.cursor.fetchall())
 
     def get_mosaiq_obsset(self, setid):
         """Get a set of MosaiQ observation instances for the given
@@ -84,75 +114,135 @@ class MQAssessmentsSubmitter(object):
         self.cursor.execute(query, setid)
         return self.cursor.fetchall()
 
+    def get_mosaiq_obsreqs(self, machines):
+        """Get the MosaiQ ObsReq instances of several machines in a single
+           query. machines is a list of dicts with the viewid and optionally
+           the patientid, startdate and watermark of each machine. Returns
+           the instances with their VIEW_OBD_ID and Pat_ID1. Unlike
+           get_mosaiq_obsreq, the IDs are compared as integers with = (the
+           same rows as LIKE without wildcards) so that indexes can be used.
+           Use match_machine to find the machine of each instance."""
+
+        conditions = []
+        params = []
+        for m in machines:
+            condition = "(VIEW_OBD_ID = %d"
+            params.append(int(m['viewid']))
+            if m.get('patientid') is not None:
+                condition += " AND Pat_ID1 = %d"
+                params.append(int(m['patientid']))
+            condition += " AND Create_DtTm >= CONVERT(datetime, %s)"
+            params.append(m.get('startdate') or "19010101")
+            watermark = m.get('watermark')
+            if watermark is not None:
+                condition += """ AND Create_DtTm >= %s
+                                 AND (Create_DtTm > %s OR OBR_Set_ID > %d)"""
+                params.extend([watermark[0], watermark[0], watermark[1]])
+            conditions.append(condition + ")")
+
+        query = """SELECT OBR_Set_ID, Create_DtTm, VIEW_OBD_ID, Pat_ID1
+                   FROM ObsReq WHERE """ + " OR ".join(conditions) + \
+            " ORDER BY Create_DtTm, OBR_Set_ID;"
+        logger.debug("Obsreqs Query: %s", query)
+        self.cursor.execute(query, tuple(params))
+        return list(self.cursor.fetchall())
+
+    def get_mosaiq_obssets(self, setids, batchsize=500):
+        """Get the MosaiQ observation instances of several observation
+           sets using one query per batch of set IDs. Returns a dict of
+           the observations of each set ID, so all of them are held in
+           memory. Pass a bounded list of set IDs (as submit_assessments
+           does for each batch) to bound the memory used."""
+
+        obssets = dict((setid, []) for setid in setids)
+        for n in range(0, len(setids), batchsize):
+            batch = setids[n:n + batchsize]
+            query = """SELECT OBX_ID, OBR_Set_ID, Pat_ID1, OBD_ID,
+                       Obs_Float, Obs_String FROM Observe WHERE
+                       OBR_Set_ID IN (""" + \
+                ", ".join(["%d"] * len(batch)) + ");"
+            self.cursor.execute(query, tuple(batch))
+            # Fetch in chunks to avoid building a second list of the rows
+            while True:
+                rows = self.cursor.fetchmany(batchsize)
+                if not rows:
+                    break
+                for row in rows:
+                    obssets[row[1]].append(row)
+        return obssets
+
     def convert_test_result(self, data, mapping, date):
-        """Convert the test result into a dictonary compatible with the
+        """Convert the test result into a payload compatible with the
            QATrack+ UnitTestCollection."""
 
+        if self.compiledmapping[0] is not mapping:
+            self.compiledmapping = (mapping, compile_mapping(mapping))
+        obdforms, numforms = self.compiledmapping[1]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Mapping: %s', pprint.pformat(mapping))
+
         # Create the test results set
-        test_results = {}
+        test_results = payload.TestResultsPayload(
+            total_forms=str(len(numforms)))
+        if len(numforms):
+            test_results.resize(numforms[-1] + 1)
+        fields = {}
         for x in data:
             logger.debug('Test: %s', x)
-            if str(x[3]) in mapping:
-                m = mapping[str(x[3])]
-                key = "form-" + str(m[0]) + "-value"
-                if "bool" in str(m[1]):
-                    test_results[key] = int(x[4])
-                elif "float" in str(m[1]):
-                    test_results[key] = x[4]
-                elif "str" in str(m[1]):
-                    test_results[key] = x[5].rstrip()
-
-        logger.debug('Mapping: %s', pprint.pformat(mapping))
-        logger.debug('Test Results without skips: %s',
-                     pprint.pformat(test_results))
+            form = obdforms.get(str(x[3]))
+            if form is None:
+                continue
+            if form[1] == "bool":
+                value = int(x[4])
+            elif form[1] == "float":
+                value = x[4]
+            elif form[1] == "str":
+                value = x[5].rstrip()
+            else:
+                continue
+            if isinstance(form[0], int):
+                test_results.set_value(form[0], value)
+            else:
+                fields[form[0]] = value
 
         # Add the skipped items
-        for k, m in mapping.items():
-            if not "form-" + str(m[0]) + "-value" in test_results:
-                test_results["form-" + str(m[0]) + "-skipped"] = "1"
+        flags = test_results.flags
+        for n in numforms:
+            if flags[n] == payload.ABSENT:
+                test_results.set_skipped(n)
 
         # Insert operator and approval initials and comments
         comment = ""
-        if "form-user-value" in test_results:
-            comment += "Performed by " + test_results.pop("form-user-value")
-        else:
-            del test_results["form-user-skipped"]
+        if "user" in fields:
+            comment += "Performed by " + fields["user"]
         # Set review status to approved if instance has already been checked
-        if "form-approval-value" in test_results:
-            comment += "\nReviewed by " + \
-                test_results.pop("form-approval-value")
-            # status (1: Unreviewed, 2: Approved 3 :Rejected)
-            test_results["status"] = 2
+        # (1: Unreviewed, 2: Approved 3 :Rejected)
+        if "approval" in fields:
+            comment += "\nReviewed by " + fields["approval"]
+            test_results.status = 2
         else:
-            test_results["status"] = 1
-            del test_results["form-approval-skipped"]
-        if "form-comment-value" in test_results:
-            comment += "\n" + test_results["form-comment-value"]
-            del test_results["form-comment-value"]
-        else:
-            del test_results["form-comment-skipped"]
+            test_results.status = 1
+        if "comment" in fields:
+            comment += "\n" + fields["comment"]
         comment += "\nRow " + str(data[0][1])
-        test_results["comment"] = comment
+        test_results.comment = comment
 
         # Add the management form data
-        num_fields = str(len(test_results) - 2)
-        test_results.update({
-            "work_started": date.strftime("%d-%m-%Y %H:%M"),
-            "work_completed": (date + datetime.timedelta(
-                minutes=30)).strftime("%d-%m-%Y %H:%M"),
-            "form-TOTAL_FORMS": num_fields,
-            "form-INITIAL_FORMS": num_fields,
-            "form-MAX_NUM_FORMS": "1000"
-        })
-
-        logger.debug('Test Results (Full): %s', pprint.pformat(test_results))
+        test_results.work_started = date.strftime("%d-%m-%Y %H:%M")
+        test_results.work_completed = (date + datetime.timedelta(
+            minutes=30)).strftime("%d-%m-%Y %H:%M")
+
+        logger.debug('Test Results (Full): %s', test_results)
 
         return test_results
 
     def submit_data(self, viewid=None, startdate=None, enddate=None,
                     patientid=None, utc=6, mapping=None, progressfunc=None,
-                    updatefunc=None, dryrun=False):
-        """Submit the test results to the QATrack+ server"""
+                    updatefunc=None, dryrun=False, watermark=None):
+        """Submit the test results to the QATrack+ server. The progress
+           passed to updatefunc is the watermark of the last submitted
+           assessment (see format_watermark). progressfunc is either a
+           function called with status messages or a progress.ProgressBus."""
 
         # Set a default mapping
         if mapping is None:
@@ -181,74 +271,197 @@ class MQAssessmentsSubmitter(object):
                 }
 
         # Connect to the QATrack Server
-        if progressfunc:
-            progressfunc("Connecting to QATrack+ Server...")
+        bus = progress.get_progress_bus(progressfunc)
+        bus.start(utc)
+        bus.message("Connecting to QATrack+ Server...")
         logger.info("Connecting to QATrack+ Server...")
-        rs = resultssubmitter.ResultsSubmitter(
-            self.qat_url, self.qat_username, self.qat_password)
-        logger.debug("%s %s %s",
-                     self.qat_url, self.qat_username, self.qat_password)
-
-        # Connect to the MosaiQ DB Server
-        if progressfunc:
-            progressfunc("Connecting to MosaiQ database...")
-        obsreqs = self.get_mosaiq_obsreq(viewid, startdate, enddate, patientid)
-        logger.debug("Obsreqs: %s", obsreqs)
-        logger.info("Number of rows: %d", len(obsreqs))
-        if len(obsreqs):
-            logger.info("Dates from: %s, %s",
-                        obsreqs[0][1].strftime(dtformat),
-                        obsreqs[-1][1].strftime(dtformat))
-        else:
-            nodatamsg = "No data to import from " + \
-                str(startdate) + " to " + str(enddate) + "."
-            if progressfunc:
-                progressfunc(nodatamsg)
-            logger.info(nodatamsg)
-            return
+        with resultssubmitter.ResultsSubmitter(
+                self.qat_url, self.qat_username, self.qat_password,
+                ratecontroller=self.ratecontroller,
+                schemacache=self.schemacache) as rs:
+            logger.debug("%s %s %s",
+                         self.qat_url, self.qat_username, self.qat_password)
+
+            # Connect to the MosaiQ DB Server
+            bus.message("Connecting to MosaiQ database...")
+            obsreqs = self.get_mosaiq_obsreq(
+                viewid, startdate, enddate, patientid, watermark)
+            logger.debug("Obsreqs: %s", obsreqs)
+            logger.info("Number of rows: %d", len(obsreqs))
+            if len(obsreqs):
+                logger.info("Dates from: %s, %s",
+                            obsreqs[0][1].strftime(dtformat),
+                            obsreqs[-1][1].strftime(dtformat))
+            else:
+                nodatamsg = "No data to import from " + \
+                    str(startdate) + " to " + str(enddate) + "."
+                bus.finish(nodatamsg)
+                logger.info(nodatamsg)
+                return
+
+            self.submit_assessments(
+                rs, obsreqs, mapping, utc, bus, updatefunc, dryrun)
+
+    def submit_assessments(self, rs, obsreqs, mapping, utc, bus,
+                           updatefunc=None, dryrun=False, batchsize=None):
+        """Convert and submit the given ObsReq instances of a machine.
+           The observations are queried for each instance, or for each
+           batch of batchsize instances if batchsize is given."""
 
         # Iterate over the selected rows
         start = 1
         end = len(obsreqs)
         rownum = start
         logger.info("Number of rows: %d", end)
-        for obsreq in obsreqs:
+        bus.start(utc, end)
+        obssets = {}
+        for n, obsreq in enumerate(obsreqs):
             date = obsreq[1].strftime(dtformat)
             logger.info("Row # %s, Date: %s",
                         rownum, date)
-            data = self.get_mosaiq_obsset(obsreq[0])
+            if batchsize is None:
+                data = self.get_mosaiq_obsset(obsreq[0])
+            else:
+                # Only the observations of one batch are held in memory
+                if n % batchsize == 0:
+                    obssets = self.get_mosaiq_obssets(
+                        [o[0] for o in obsreqs[n:n + batchsize]], batchsize)
+                data = obssets.pop(obsreq[0])
             logger.debug("Data: %s %d", data, len(data))
             try:
                 test_results = self.convert_test_result(
                     data, mapping, obsreq[1])
             except:
-                if updatefunc:
-                    updatefunc(utc, date)
-                raise Exception("Error with assessment from : " + date +
-                                ". Please check data and retry.")
-            # Update the progress function
-            if progressfunc:
-                progressfunc(
-                    "Reading record: " + str(rownum) + " of " + str(end))
+                msg = "Error with assessment from : " + date + \
+                    ". Please check data and retry."
+                bus.error(msg)
+                raise Exception(msg)
+            # Update the progress
+            bus.update(rownum)
             # If the test results aren't None, submit to server
-            if test_results and not dryrun:
-                logger.info("Submitting Row # %s to server", rownum)
-                text = rs.submit_data(utc, test_results)
+            try:
+                if test_results and not dryrun:
+                    logger.info("Submitting Row # %s to server", rownum)
+                    text = rs.submit_data(utc, test_results)
+                    with open("result.html", 'w') as f:
+                        f.write(text)
+                elif test_results:
+                    rs.validate_data(utc, test_results)
+            except resultssubmitter.SubmissionError as e:
+                # Keep the rejected form to show why it was not accepted
                 with open("result.html", 'w') as f:
-                    f.write(text)
+                    f.write(e.text)
+                bus.error(e)
+                raise
+            except Exception as e:
+                bus.error(e)
+                raise
             rownum = rownum + 1
             # Update the update function after the result has been submitted
-            dateplusone = (obsreq[1] + datetime.timedelta(days=1)).strftime(
-                dtformat)
             if updatefunc:
-                updatefunc(utc, dateplusone)
+                updatefunc(utc, format_watermark(obsreq))
 
         completionmsg = "Imported " + str(rownum - 1) + " rows from " + \
-            str(startdate) + " to " + dateplusone + "."
-        if progressfunc:
-            progressfunc(completionmsg)
+            obsreqs[0][1].strftime(dtformat) + " to " + date + "."
+        bus.finish(completionmsg)
         logger.info(completionmsg)
 
+    def submit_machines(self, machines, progressfunc=None, updatefunc=None,
+                        dryrun=False, batchsize=500):
+        """Submit the test results of several machines to the QATrack+
+           server, querying the assessments of all machines at once.
+           machines is a list of dicts with the viewid, utc, mapping and
+           optionally the patientid, startdate and watermark of each
+           machine (see get_mosaiq_obsreqs). The observations are
+           queried and submitted in batches of batchsize assessments."""
+
+        bus = progress.get_progress_bus(progressfunc)
+        bus.start(None)
+        bus.message("Connecting to QATrack+ Server...")
+        logger.info("Connecting to QATrack+ Server...")
+        with resultssubmitter.ResultsSubmitter(
+                self.qat_url, self.qat_username, self.qat_password,
+                ratecontroller=self.ratecontroller,
+                schemacache=self.schemacache) as rs:
+
+            # Query the assessments of all machines
+            bus.message("Connecting to MosaiQ database...")
+            obsreqs = self.get_mosaiq_obsreqs(machines)
+            logger.info("Number of rows: %d", len(obsreqs))
+
+            # Split the assessments by machine and submit them
+            machinereqs = [[o for o in obsreqs if match_machine(m, o)]
+                           for m in machines]
+            del obsreqs
+            for m, reqs in zip(machines, machinereqs):
+                if not len(reqs):
+                    nodatamsg = "No data to import for UTC " + \
+                        str(m['utc']) + "."
+                    bus.finish(nodatamsg)
+                    logger.info(nodatamsg)
+                    continue
+                self.submit_assessments(
+                    rs, reqs, m['mapping'], m['utc'], bus, updatefunc,
+                    dryrun, batchsize)
+
+
+def match_machine(machine, obsreq):
+    """Return True if the ObsReq instance returned by get_mosaiq_obsreqs
+       is an assessment of the machine (a dict as in submit_machines)
+       created after its startdate and watermark."""
+
+    if int(obsreq[2]) != int(machine['viewid']):
+        return False
+    if machine.get('patientid') is not None and \
+            int(obsreq[3]) != int(machine['patientid']):
+        return False
+    if machine.get('startdate') and obsreq[1] < \
+            datetime.datetime.strptime(machine['startdate'], dtformat):
+        return False
+    # The same condition as the keyset condition of the query
+    watermark = machine.get('watermark')
+    if watermark is not None and \
+            (obsreq[1], obsreq[0]) <= (watermark[0], watermark[1]):
+        return False
+    return True
+
+
+def compile_mapping(mapping):
+    """Compile a mapping of OBD_IDs to [form, type] lists. Returns a dict
+       of OBD_IDs to (form, type) tuples, where form is the form number or
+       the name of a comment field (user, approval or comment) and type is
+       bool, float, str or None, and the sorted list of form numbers."""
+
+    obdforms = {}
+    for obdid, m in mapping.items():
+        form = int(m[0]) if str(m[0]).isdigit() else str(m[0])
+        vartype = None
+        for t in ("bool", "float", "str"):
+            if t in str(m[1]):
+                vartype = t
+                break
+        obdforms[str(obdid)] = (form, vartype)
+    numforms = sorted(set(f[0] for f in obdforms.values()
+                          if isinstance(f[0], int)))
+    return obdforms, numforms
+
+
+def format_watermark(obsreq):
+    """Return the watermark of the given ObsReq instance as a JSON
+       serializable list of the Create_DtTm and the OBR_Set_ID."""
+
+    return [obsreq[1].strftime(watermarkformat), obsreq[0]]
+
+
+def parse_watermark(progress):
+    """Return the (Create_DtTm, OBR_Set_ID) tuple of a watermark created
+       by format_watermark, or None if the progress is a date string."""
+
+    if not isinstance(progress, list):
+        return None
+    return (datetime.datetime.strptime(progress[0], watermarkformat),
+            progress[1])
+
 if __name__ == '__main__':
 
     import sys
@@ -309,8 +522,9 @@ if __name__ == '__main__':
         logger.debug(args)
 
     # Read and submit the MosaiQ Database Assessments
-    reader = MQAssessmentsSubmitter(args.server, args.username, args.password)
-    reader.submit_data(
-        viewid=args.viewid, startdate=args.date, enddate=args.enddate,
-        patientid=args.patientid, utc=args.utc, progressfunc=logger.debug,
-        dryrun=args.dryrun)
+    with MQAssessmentsSubmitter(
+            args.server, args.username, args.password) as reader:
+        reader.submit_data(
+            viewid=args.viewid, startdate=args.date, enddate=args.enddate,
+            patientid=args.patientid, utc=args.utc,
+            progressfunc=logger.debug, dryrun=args.dryrun)
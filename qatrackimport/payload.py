@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# payload.py
+"""Compact representation of test results submitted to QATrack+."""
+# Copyright (c) 2015 Aditya Panchal
+
+import array
+import sys
+try:
+    from urllib import quote_plus
+except ImportError:
+    from urllib.parse import quote_plus
+
+try:
+    intern = sys.intern
+    text_type = str
+except AttributeError:
+    text_type = unicode
+
+# Flags for each form of the UnitTestCollection
+ABSENT, VALUE, SKIPPED = 0, 1, 2
+
+# Interned field names and their url-encoded prefixes, indexed by form number
+fieldnames = []
+
+
+def get_field_names(n):
+    """Return the (value, skipped) field names and their url-encoded
+       prefixes for form n."""
+
+    while len(fieldnames) <= n:
+        value = intern("form-" + str(len(fieldnames)) + "-value")
+        skipped = intern("form-" + str(len(fieldnames)) + "-skipped")
+        fieldnames.append((value, skipped, value + "=", skipped + "=1"))
+    return fieldnames[n]
+
+
+def encode_value(value):
+    """Url-encode a form value the same way requests does."""
+
+    if not isinstance(value, (bytes, text_type)):
+        value = str(value)
+    if isinstance(value, text_type):
+        value = value.encode('utf-8')
+    return quote_plus(value)
+
+
+class TestResultsPayload(object):
+    """Class that holds the test results of a UnitTestCollection as an
+       array of form values which is url-encoded only once."""
+    __slots__ = ('work_started', 'work_completed', 'status', 'comment',
+                 'total_forms', 'flags', 'values', 'encoded')
+
+    def __init__(self, work_started=None, work_completed=None, status=None,
+                 comment=None, total_forms=None):
+
+        self.work_started = work_started
+        self.work_completed = work_completed
+        self.status = status
+        self.comment = comment
+        self.total_forms = total_forms
+        self.flags = array.array('b')
+        self.values = []
+        self.encoded = None
+
+    def resize(self, n):
+        """Make room for at least n forms."""
+
+        if len(self.values) < n:
+            self.flags.extend([ABSENT] * (n - len(self.values)))
+            self.values.extend([None] * (n - len(self.values)))
+
+    def set_value(self, n, value):
+        """Set the value of form n. A value of None (i.e. a NULL MosaiQ
+           observation) marks the form as skipped since it has no value."""
+
+        if value is None:
+            self.set_skipped(n)
+            return
+        self.resize(n + 1)
+        self.flags[n] = VALUE
+        self.values[n] = value
+        self.encoded = None
+
+    def set_skipped(self, n):
+        """Mark form n as skipped."""
+
+        self.resize(n + 1)
+        self.flags[n] = SKIPPED
+        self.values[n] = None
+        self.encoded = None
+
+    def get_management_items(self):
+        """Return the (field name, value) pairs of the fields other than
+           the test values."""
+
+        items = [("work_started", self.work_started),
+                 ("work_completed", self.work_completed),
+                 ("status", self.status),
+                 ("comment", self.comment),
+                 ("form-TOTAL_FORMS", self.total_forms),
+                 ("form-INITIAL_FORMS", self.total_forms),
+                 ("form-MAX_NUM_FORMS", "1000")]
+        return [i for i in items if i[1] is not None]
+
+    def items(self):
+        """Return the (field name, value) pairs of the payload."""
+
+        items = self.get_management_items()
+        for n, flag in enumerate(self.flags):
+            if flag == VALUE:
+                items.append((get_field_names(n)[0], self.values[n]))
+            elif flag == SKIPPED:
+                items.append((get_field_names(n)[1], "1"))
+        return items
+
+    def to_dict(self):
+        """Return the test results dictionary of the payload."""
+
+        return dict(self.items())
+
+    def encode(self, token=None):
+        """Return the url-encoded payload as bytes, including the CSRF
+           token if given. The test results are only encoded once."""
+
+        if self.encoded is None:
+            parts = [name + "=" + encode_value(value)
+                     for name, value in self.get_management_items()]
+            for n, flag in enumerate(self.flags):
+                if flag == VALUE:
+                    parts.append(get_field_names(n)[2] +
+                                 encode_value(self.values[n]))
+                elif flag == SKIPPED:
+                    parts.append(get_field_names(n)[3])
+            self.encoded = "&".join(parts).encode('ascii')
+        if token is None:
+            return self.encoded
+        return self.encoded + b"&csrfmiddlewaretoken=" + \
+            encode_value(token).encode('ascii')
+
+    def __getstate__(self):
+        # The encoded payload is left out since it duplicates the values
+        return (self.work_started, self.work_completed, self.status,
+                self.comment, self.total_forms, self.flags.tostring()
+                if sys.version_info[0] < 3 else self.flags.tobytes(),
+                self.values)
+
+    def __setstate__(self, state):
+        (self.work_started, self.work_completed, self.status,
+         self.comment, self.total_forms, flags, self.values) = state
+        self.encoded = None
+        self.flags = array.array('b')
+        if sys.version_info[0] < 3:
+            self.flags.fromstring(flags)
+        else:
+            self.flags.frombytes(flags)
+
+    def __repr__(self):
+        return "TestResultsPayload(%r)" % self.to_dict()
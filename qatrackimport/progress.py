@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# progress.py
+"""Report the progress of an import as a throttled stream of events."""
+# Copyright (c) 2015 Aditya Panchal
+
+import datetime
+import time
+import logging
+logger = logging.getLogger('qatrackimport.progress')
+
+
+class ProgressEvent(object):
+    """Class that holds the progress of the import of a machine."""
+    __slots__ = ('machine', 'done', 'total', 'row', 'rate', 'eta',
+                 'lasterror', 'message', 'final')
+
+    def __init__(self, machine=None, done=0, total=None, row=None, rate=None,
+                 eta=None, lasterror=None, message=None, final=False):
+
+        self.machine = machine
+        self.done = done
+        self.total = total
+        self.row = row
+        self.rate = rate
+        self.eta = eta
+        self.lasterror = lasterror
+        self.message = message
+        self.final = final
+
+
+def format_event(event):
+    """Format a progress event as a status message."""
+
+    if event.message is not None:
+        return event.message
+    msg = "Reading record: " + str(event.done) + " of " + str(event.total)
+    if event.row is not None:
+        msg += " [Row " + str(event.row) + "]"
+    if event.rate:
+        msg += " (%.1f rows/s" % event.rate
+        if event.eta is not None:
+            msg += ", ETA " + str(datetime.timedelta(seconds=int(event.eta)))
+        msg += ")"
+    if event.lasterror is not None:
+        msg += " Last error: " + event.lasterror
+    return msg
+
+
+class ProgressBus(object):
+    """Class that publishes progress events to its subscribers. Row updates
+       are coalesced so that subscribers are called at most once every
+       interval seconds."""
+    def __init__(self, interval=0.25):
+
+        self.interval = interval
+        self.subscribers = []
+        self.start(None)
+
+    def subscribe(self, func):
+        """Call func with each published ProgressEvent. A function is only
+           subscribed once."""
+
+        if func not in self.subscribers:
+            self.subscribers.append(func)
+
+    def start(self, machine, total=None):
+        """Start reporting the progress of a machine."""
+
+        self.machine = machine
+        self.total = total
+        self.done = 0
+        self.row = None
+        self.lasterror = None
+        self.started = time.time()
+        self.published = 0
+
+    def update(self, done, row=None):
+        """Update the number of rows done. This is cheap enough to be
+           called for every row."""
+
+        self.done = done
+        self.row = row
+        if time.time() - self.published >= self.interval:
+            self.publish()
+
+    def error(self, error):
+        """Report an error (which is always published)."""
+
+        self.lasterror = str(error)
+        self.publish()
+
+    def message(self, message, final=False):
+        """Publish a status message."""
+
+        self.publish(message, final)
+
+    def finish(self, message=None):
+        """Publish the final progress of the machine."""
+
+        self.publish(message, final=True)
+
+    def publish(self, message=None, final=False):
+        """Publish an event with the current progress to the subscribers."""
+
+        now = time.time()
+        self.published = now
+        if not len(self.subscribers):
+            return
+        elapsed = now - self.started
+        rate = self.done / elapsed if elapsed > 0 and self.done else None
+        eta = (self.total - self.done) / rate \
+            if rate and self.total is not None else None
+        event = ProgressEvent(self.machine, self.done, self.total, self.row,
+                              rate, eta, self.lasterror, message, final)
+        for func in self.subscribers:
+            try:
+                func(event)
+            except Exception:
+                logger.exception("Progress subscriber failed")
+
+
+def get_progress_bus(progressfunc=None):
+    """Return a ProgressBus for the progressfunc argument of the submitters.
+       A ProgressBus is returned as is, while a function is called with the
+       formatted status message of each event."""
+
+    if isinstance(progressfunc, ProgressBus):
+        return progressfunc
+    bus = ProgressBus()
+    if progressfunc is not None:
+        bus.subscribe(lambda event: progressfunc(format_event(event)))
+    return bus
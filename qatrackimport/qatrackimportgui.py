@@ -26,6 +26,10 @@ import json
 import threading
 import ctdailyqasubmitter
 import mqassessmentssubmitter
+import ratecontroller
+import formschema
+import memorymonitor
+import progress
 
 
 class QATrackImportGui(QMainWindow):
@@ -52,7 +56,17 @@ class QATrackImportGui(QMainWindow):
             logger.setLevel(logging.DEBUG)
         else:
             logger.setLevel(logging.INFO)
+
+        # Remove the handlers added by a previous call so that they are
+        # not stacked (and the log file is not opened more than once)
+        for h in list(logger.handlers):
+            if h.get_name() in ('qatrackimport.console',
+                                'qatrackimport.file'):
+                logger.removeHandler(h)
+                h.close()
+
         ch = logging.StreamHandler()
+        ch.set_name('qatrackimport.console')
         ch.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
         logger.addHandler(ch)
 
@@ -60,6 +74,7 @@ class QATrackImportGui(QMainWindow):
         fhlog = 'qatrackimport.log'
         fh = logging.handlers.RotatingFileHandler(
             fhlog, maxBytes=524288, backupCount=7)
+        fh.set_name('qatrackimport.file')
         fh.setFormatter(logging.Formatter(
             '%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
         fh.setLevel(logging.DEBUG)
@@ -105,6 +120,24 @@ class QATrackImportGui(QMainWindow):
                                     "Set config.json before running.")
             self.config = {"machines": []}
 
+        # Set up the rate controller shared by all submissions
+        self.ratecontroller = ratecontroller.RateController.from_config(
+            self.config.get('rate_control', {}))
+
+        # Set up the form schema cache used to validate the test results
+        self.schemacache = formschema.SchemaCache('schemacache.json') \
+            if self.config.get('validate_forms', False) else None
+
+        # Set up the memory monitor used to bound long imports
+        self.memorymonitor = memorymonitor.MemoryMonitor.from_config(
+            self.config)
+        if self.schemacache is not None:
+            self.memorymonitor.add_release(self.schemacache.loaded.clear)
+
+        # Show the import progress in the status bar
+        self.progressbus = progress.ProgressBus()
+        self.progressbus.subscribe(self.showProgress)
+
         # Set up the progress file
         self.progressfile = 'progress.json'
         try:
@@ -139,48 +172,99 @@ class QATrackImportGui(QMainWindow):
         qatcreds = self.config['qatrack_credentials']
 
         # Determine which machines are selected
-        for i in self.ui.listMachines.selectedItems():
-            machineid = i.data(Qt.UserRole)
+        machineids = [i.data(Qt.UserRole)
+                      for i in self.ui.listMachines.selectedItems()]
+
+        # Read and convert the selected Excel files in parallel if the
+        # parse_processes setting is set
+        excelmachines = [m for m in self.config['machines']
+                         if m['id'] in machineids and
+                         m['type'] == "ct_daily_excel"]
+        cache = self.config.get('cache_workbooks', False)
+        engine = self.config.get('excel_engine', 'openpyxl')
+        dryrun = self.ui.action_Dryrun_Mode.isChecked()
+        excelresults = {}
+        if len(excelmachines) and self.config.get('parse_processes'):
+            self.ui.statusbar.showMessage("Reading Excel files...")
+            with self.memorymonitor.stage('parse'):
+                parsed = ctdailyqasubmitter.parse_workbooks(
+                    [(m["file"], self.progress[m['id']], None)
+                     for m in excelmachines],
+                    processes=self.config['parse_processes'],
+                    cache=cache, engine=engine)
+                excelresults = dict(
+                    (m['id'], r) for m, r in zip(excelmachines, parsed))
+                del parsed
+
+        for machineid in machineids:
             for m in self.config['machines']:
                 # Find the machine from config
                 if m['id'] == machineid:
                     # Submit data for CT Daily Excel
                     if m['type'] == "ct_daily_excel":
                         logger.info("Submitting data for: %s", m["name"])
-                        reader = ctdailyqasubmitter.CTDailyQASubmitter(
-                            m["file"])
-                        reader.read_excel_file()
-                        reader.set_qatrack_server(
-                            url=qatcreds['url'],
-                            username=qatcreds['username'],
-                            password=qatcreds['password'])
-                        reader.submit_data(
-                            utc=1, startrow=self.progress[m['id']],
-                            progressfunc=self.ui.statusbar.showMessage,
-                            updatefunc=self.saveProgress,
-                            dryrun=self.ui.action_Dryrun_Mode.isChecked())
-                    # Submit data for MosaiQ Assessment
-                    elif m['type'] == "mosaiq_assessment":
-                        logger.info("Submitting data for: %s", m["name"])
-                        mqcreds = self.config['mosaiq_credentials']
-                        reader = mqassessmentssubmitter.MQAssessmentsSubmitter(
-                            server=mqcreds['server'],
-                            username=mqcreds['username'],
-                            password=mqcreds['password'])
-                        reader.set_qatrack_server(
-                            url=qatcreds['url'],
-                            username=qatcreds['username'],
-                            password=qatcreds['password'])
-                        reader.submit_data(
-                            viewid=m['viewid'],
-                            startdate=self.getProgress(m['id']),
-                            patientid=m['patientid'], utc=m['id'],
-                            mapping=byteify(m['mapping']),
-                            progressfunc=self.ui.statusbar.showMessage,
-                            updatefunc=self.saveProgress,
-                            dryrun=self.ui.action_Dryrun_Mode.isChecked())
+                        with ctdailyqasubmitter.CTDailyQASubmitter(
+                                m["file"]) as reader:
+                            reader.set_qatrack_server(
+                                url=qatcreds['url'],
+                                username=qatcreds['username'],
+                                password=qatcreds['password'],
+                                ratecontroller=self.ratecontroller,
+                                schemacache=self.schemacache)
+                            # The converted rows are released once submitted
+                            results = excelresults.pop(m['id'], None)
+                            with self.memorymonitor.stage('ct_daily_excel'):
+                                if results is None:
+                                    reader.read_excel_file(cache, engine)
+                                reader.submit_data(
+                                    utc=1, startrow=self.progress[m['id']],
+                                    progressfunc=self.progressbus,
+                                    updatefunc=self.saveProgress,
+                                    dryrun=dryrun, results=results)
+                            del results
                     break
 
+        # Submit data for all selected MosaiQ Assessments at once
+        mqmachines = []
+        for m in self.config['machines']:
+            if m['id'] in machineids and m['type'] == "mosaiq_assessment":
+                logger.info("Submitting data for: %s", m["name"])
+                # Progress is either a start date (older progress files)
+                # or the watermark of the last imported assessment
+                lastprogress = self.getProgress(m['id'])
+                watermark = mqassessmentssubmitter.parse_watermark(
+                    lastprogress)
+                mqmachines.append({
+                    'viewid': m['viewid'], 'patientid': m.get('patientid'),
+                    'utc': m['id'], 'mapping': byteify(m['mapping']),
+                    'startdate': None if watermark else lastprogress,
+                    'watermark': watermark})
+        if len(mqmachines):
+            mqcreds = self.config['mosaiq_credentials']
+            with mqassessmentssubmitter.MQAssessmentsSubmitter(
+                    server=mqcreds['server'],
+                    username=mqcreds['username'],
+                    password=mqcreds['password']) as reader, \
+                    self.memorymonitor.stage('mosaiq_assessment'):
+                reader.set_qatrack_server(
+                    url=qatcreds['url'],
+                    username=qatcreds['username'],
+                    password=qatcreds['password'],
+                    ratecontroller=self.ratecontroller,
+                    schemacache=self.schemacache)
+                reader.submit_machines(
+                    mqmachines,
+                    progressfunc=self.progressbus,
+                    updatefunc=self.saveProgress,
+                    dryrun=dryrun)
+
+        self.memorymonitor.report()
+
+    def showProgress(self, event):
+        """Display a progress event in the status bar."""
+
+        self.ui.statusbar.showMessage(progress.format_event(event))
+
     def saveProgress(self, utc, progress):
         """Save the progress of the import operation to disk."""
 
@@ -189,6 +273,8 @@ class QATrackImportGui(QMainWindow):
         if not self.ui.action_Dryrun_Mode.isChecked():
             with open(self.progressfile, 'w') as p:
                 json.dump(self.progress, p)
+        # Slow down or stop the import if it uses too much memory
+        self.memorymonitor.check()
 
     def getProgress(self, utc):
         """Get the current progress of the import operation."""
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ratecontroller.py
+"""Adaptive rate control for QATrack+ submissions."""
+# Copyright (c) 2015 Aditya Panchal
+
+import collections
+import datetime
+import threading
+import time
+import logging
+logger = logging.getLogger('qatrackimport.ratecontroller')
+
+
+class RateController(object):
+    """Class that limits the rate of requests sent to the QATrack+ server
+       using additive increase / multiplicative decrease (AIMD) driven by
+       the observed latency and server errors. Submissions are sent one at
+       a time, so requests are only sent concurrently by several processes
+       (i.e. backfill workers), which divide the limits between them."""
+    def __init__(self, max_rate=5.0, min_rate=0.2, target_latency=2.0,
+                 window=10, increase=0.5, decrease=0.5, profiles=None,
+                 timeout=30, retries=3):
+
+        if min_rate <= 0:
+            raise ValueError("min_rate must be greater than 0")
+        # Ceiling used when no profile is active
+        self.max_rate = float(max_rate)
+        self.min_rate = float(min_rate)
+        self.target_latency = target_latency
+        self.increase = increase
+        self.decrease = decrease
+        self.profiles = [] if profiles is None else profiles
+        # Seconds to wait for the server before a request counts as failed
+        self.timeout = timeout
+        # Number of times a failed request is sent again after backing off
+        self.retries = retries
+
+        # Start conservatively and let the server tell us how fast to go
+        self.rate = max(self.min_rate, min(1.0, self.max_rate))
+        self.last_sent = 0
+        self.samples = collections.deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, share=1):
+        """Create a rate controller from the config.json "rate_control"
+           section. If share is more than 1, the rate limits are divided
+           by share so that share processes with their own controllers
+           stay within the configured limits together."""
+
+        keys = ['max_rate', 'min_rate', 'target_latency', 'window',
+                'increase', 'decrease', 'profiles', 'timeout', 'retries']
+        kwargs = dict((k, config[k]) for k in keys if k in config)
+        if share > 1:
+            kwargs['max_rate'] = kwargs.get('max_rate', 5.0) / float(share)
+            kwargs['min_rate'] = kwargs.get('min_rate', 0.2) / float(share)
+            profiles = []
+            for p in kwargs.get('profiles', []):
+                p = dict(p)
+                if 'max_rate' in p:
+                    p['max_rate'] = p['max_rate'] / float(share)
+                profiles.append(p)
+            kwargs['profiles'] = profiles
+        return cls(**kwargs)
+
+    def get_max_rate(self, now=None):
+        """Return the rate ceiling of the active profile. Profiles are
+           dicts with "start" and "end" times as "HH:MM" and an optional
+           "max_rate" override. The ceiling is never below min_rate."""
+
+        now = datetime.datetime.now() if now is None else now
+        current = now.strftime("%H:%M")
+        max_rate = self.max_rate
+        for p in self.profiles:
+            start, end = p['start'], p['end']
+            # Profiles may wrap past midnight (i.e. 18:00 - 07:00)
+            if (start <= current < end) if start <= end else \
+                    (current >= start or current < end):
+                max_rate = float(p.get('max_rate', self.max_rate))
+                break
+        return max(self.min_rate, max_rate)
+
+    def acquire(self):
+        """Block until a request may be sent to the server."""
+
+        with self.lock:
+            rate = min(self.rate, self.get_max_rate())
+            wait = self.last_sent + 1.0 / rate - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            self.last_sent = time.time()
+
+    def release(self, latency, failed=False):
+        """Record the outcome of a request and adjust the rate. A failed
+           request (a 5xx response or a timeout) always backs off."""
+
+        with self.lock:
+            self.samples.append(latency)
+            max_rate = self.get_max_rate()
+            mean_latency = sum(self.samples) / len(self.samples)
+            if failed or mean_latency > self.target_latency:
+                # Back off multiplicatively and start a fresh window so
+                # the server has time to recover before the next decision
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self.samples.clear()
+                logger.info("Backing off: rate %.2f/s (latency %.2fs%s)",
+                            self.rate, mean_latency,
+                            ", failed" if failed else "")
+            else:
+                self.rate = min(max_rate, self.rate + self.increase)
+                logger.debug("Rate %.2f/s", self.rate)
@@ -7,29 +7,75 @@
 # https://groups.google.com/d/topic/qatrack/vO5H-zsfgsc/discussion
 
 import requests
+import time
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+import formschema
 import logging
 logger = logging.getLogger('qatrackimport.resultssubmitter')
 
 
+class SubmissionError(Exception):
+    """Raised when QATrack+ does not accept the submitted test results.
+       The text of the response (the form with its errors) is kept in
+       text."""
+    def __init__(self, message, text=None):
+        Exception.__init__(self, message)
+        self.text = text
+
+
+class LoginError(SubmissionError):
+    """Raised when the QATrack+ server does not accept the login."""
+    pass
+
+
 class ResultsSubmitter(object):
     """Class that will submit test results to a QATrack+ Server."""
-    def __init__(self, url, username, password):
+    def __init__(self, url, username, password, ratecontroller=None,
+                 timeout=None, schemacache=None, retries=None):
 
         self.url = url
         self.username = username
         self.password = password
+        # Optional RateController used to throttle submissions
+        self.ratecontroller = ratecontroller
+        # Use the timeout of the rate controller unless one is given
+        if timeout is None and ratecontroller is not None:
+            timeout = ratecontroller.timeout
+        self.timeout = timeout
+        # Failed submissions are only retried if the rate controller can
+        # back off before sending them again
+        if retries is None:
+            retries = 0 if ratecontroller is None else ratecontroller.retries
+        self.retries = retries
+        # Optional SchemaCache used to validate results before submission
+        self.schemacache = schemacache
 
         # Set up a requests session
         self.session = requests.Session()
 
         self.login()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the connections and clear the cookies of the session."""
+
+        self.session.cookies.clear()
+        self.session.close()
+
     def login(self):
         """Login to the QATrack+ server."""
 
         # HTTP GET the login page to retrieve the CSRF token
         login_url = self.url + "accounts/login/"
-        self.session.get(login_url)
+        self.session.get(login_url, timeout=self.timeout)
         self.token = self.session.cookies['csrftoken']
 
         login_data = {
@@ -39,24 +85,107 @@ class ResultsSubmitter(object):
         }
 
         # Perform the login
-        r = self.session.post(login_url, data=login_data)
+        r = self.session.post(login_url, data=login_data,
+                              timeout=self.timeout)
         logger.debug("URL: %s Headers: %s Status code: %s",
                      r.url, r.headers, r.status_code)
 
+        # A successful login redirects away from the login page
+        if not len(r.history) or self.is_login_page(r.url):
+            raise LoginError(
+                "Unable to log in to QATrack+ as " + self.username +
+                " (status code " + str(r.status_code) + ").", r.text)
+
+    def is_login_page(self, url):
+        """Return True if the url is the login page of the server."""
+
+        return urlparse(url).path.endswith("/accounts/login/")
+
+    def get_schema(self, utc):
+        """Fetch and parse the form schema of the UnitTestCollection."""
+
+        r = self.session.get(self.url + "qa/utc/perform/" + str(utc) + "/",
+                             timeout=self.timeout)
+        return formschema.FormSchema.from_html(r.text)
+
+    def validate_data(self, utc, test_results):
+        """Validate the test results against the cached form schema of
+           the UnitTestCollection (if a schema cache is used)."""
+
+        if self.schemacache is not None:
+            schema = self.schemacache.get(utc, self.get_schema)
+            try:
+                schema.validate(test_results)
+            except formschema.SchemaValidationError as e:
+                raise formschema.SchemaValidationError(
+                    "UTC " + str(utc) + ": " + str(e))
+
     def submit_data(self, utc, test_results):
         """Submit the test results to the server."""
 
+        # Fail before the round-trip if the results don't match the form
+        self.validate_data(utc, test_results)
+
         # URL of UnitTestCollection (UTC) that is to be performed
         test_list_url = self.url + "qa/utc/perform/" + str(utc) + "/"
 
-        test_results['csrfmiddlewaretoken'] = self.token
+        # Test results are either a dict or a pre-encoded TestResultsPayload
         logger.debug("Test results: %s", test_results)
+        if isinstance(test_results, dict):
+            test_results['csrfmiddlewaretoken'] = self.token
+            headers = None
+        else:
+            test_results = test_results.encode(self.token)
+            headers = {'Content-Type': 'application/x-www-form-urlencoded'}
 
-        # Submit test data
-        r = self.session.post(test_list_url, data=test_results)
+        # Submit test data (throttled by the rate controller if present).
+        # Server errors and timeouts are retried after the rate controller
+        # has backed off, since they are usually caused by a busy server
+        attempt = 0
+        while True:
+            if self.ratecontroller:
+                self.ratecontroller.acquire()
+            failed = True
+            start = time.time()
+            try:
+                r = self.session.post(test_list_url, data=test_results,
+                                      headers=headers, timeout=self.timeout)
+                failed = r.status_code >= 500
+            except requests.Timeout:
+                # Timeouts count as failures so that the rate controller
+                # backs off
+                logger.warning("Submission to UTC %s timed out after %s s",
+                               utc, self.timeout)
+                if attempt >= self.retries:
+                    raise
+            finally:
+                if self.ratecontroller:
+                    self.ratecontroller.release(time.time() - start, failed)
+            if not failed or attempt >= self.retries:
+                break
+            attempt += 1
+            logger.warning("Retrying submission to UTC %s (attempt %d of %d)",
+                           utc, attempt, self.retries)
         logger.debug("URL: %s Headers: %s Status code: %s",
                      r.url, r.headers, r.status_code)
 
+        # The session has expired if the submission was redirected to the
+        # login page, in which case nothing was stored
+        if self.is_login_page(r.url):
+            raise SubmissionError(
+                "UTC " + str(utc) + ": The test results were not accepted " +
+                "since the QATrack+ session has expired.", r.text)
+
+        # A successful submission redirects, otherwise the form was shown
+        # again with errors so the test list may have changed
+        if not len(r.history):
+            if self.schemacache is not None:
+                self.schemacache.invalidate(utc)
+            raise SubmissionError(
+                "UTC " + str(utc) + ": The test results were not accepted " +
+                "by QATrack+ (status code " + str(r.status_code) + ").",
+                r.text)
+
         # Return the response text
         return r.text
 
@@ -129,8 +258,8 @@ if __name__ == '__main__':
         test_results["form-" + str(n) + "-value"] = "1"
 
     # Submit the results
-    rs = ResultsSubmitter(url, username, password)
-    text = rs.submit_data(utc, test_results)
+    with ResultsSubmitter(url, username, password) as rs:
+        text = rs.submit_data(utc, test_results)
 
     # Write out the response text if requested
     if args.output:
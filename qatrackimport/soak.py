@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# soak.py
+"""Long-run soak test of the submitters against local stand-ins."""
+# Copyright (c) 2015 Aditya Panchal
+
+import datetime
+import gc
+import threading
+import time
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+import benchmark
+import ctdailyqasubmitter
+import memorymonitor
+import mqassessmentssubmitter
+import logging
+logger = logging.getLogger('qatrackimport.soak')
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    """Handler that answers the requests of ResultsSubmitter the way a
+       QATrack+ server does, without storing anything."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_text(self, status, text=b'', location=None):
+        self.send_response(status)
+        self.send_header('Set-Cookie', 'csrftoken=standin; Path=/')
+        if location is not None:
+            self.send_header('Location', location)
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def do_GET(self):
+        self.send_text(200, b'<html></html>')
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.posts += 1
+        # Successful logins and submissions redirect
+        self.send_text(302, location='/qa/')
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """Local stand-in for a QATrack+ server on a free port."""
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInRequestHandler)
+        self.posts = 0
+        self.url = "http://127.0.0.1:" + str(self.server_port) + "/"
+
+
+class StandInCursor(object):
+    """Cursor that returns synthetic MosaiQ ObsReq and Observe rows."""
+    def __init__(self, assessments, viewid, patientid):
+
+        self.obsreqs = [(obs[0][1], date, viewid, patientid)
+                        for obs, date in assessments]
+        self.observations = [o for obs, date in assessments for o in obs]
+        self.rows = []
+
+    def execute(self, query, params=None):
+        if 'FROM ObsReq' in query:
+            self.rows = list(self.obsreqs)
+        else:
+            setids = set(params)
+            self.rows = [o for o in self.observations if o[1] in setids]
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def fetchmany(self, size=1):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def close(self):
+        self.rows = None
+
+
+class StandInConnection(object):
+    """Connection that returns a StandInCursor."""
+    def __init__(self, cursor):
+        self.standin = cursor
+
+    def cursor(self):
+        return self.standin
+
+    def close(self):
+        self.standin = None
+
+
+class StandInMQSubmitter(mqassessmentssubmitter.MQAssessmentsSubmitter):
+    """MQAssessmentsSubmitter that reads synthetic assessments instead of
+       connecting to the MosaiQ database."""
+    def __init__(self, assessments, viewid=1, patientid=1):
+
+        self.assessments = assessments
+        self.viewid = viewid
+        self.patientid = patientid
+        mqassessmentssubmitter.MQAssessmentsSubmitter.__init__(self)
+
+    def connect_to_database(self):
+        self.conn = StandInConnection(StandInCursor(
+            self.assessments, self.viewid, self.patientid))
+        self.cursor = self.conn.cursor()
+
+
+def run_round(server, monitor, seed, rows=200, filename=None,
+              engine='openpyxl'):
+    """Convert and submit a round of synthetic CT Daily QA rows and MosaiQ
+       assessments (and read the Excel file if given) while measuring
+       the resident memory of each stage."""
+
+    def updatefunc(utc, progress):
+        monitor.check()
+
+    if filename is not None:
+        with monitor.stage('read'):
+            with ctdailyqasubmitter.CTDailyQASubmitter(filename) as reader:
+                reader.read_excel_file(engine=engine)
+                for values in reader.iter_rows(1, reader.max_row):
+                    pass
+
+    with monitor.stage('ct_daily_excel'):
+        reader = ctdailyqasubmitter.CTDailyQASubmitter(None)
+        reader.set_qatrack_server(server.url, 'admin', 'admin')
+        results = [(n, reader.convert_test_result(data, n)) for n, data in
+                   enumerate(benchmark.make_ct_rows(rows, seed), 1)]
+        reader.submit_data(utc=1, updatefunc=updatefunc, results=results)
+        del results
+
+    with monitor.stage('mosaiq_assessment'):
+        mapping, assessments = benchmark.make_mq_assessments(
+            rows // 10, numtests=20, seed=seed)
+        with StandInMQSubmitter(assessments) as reader:
+            reader.set_qatrack_server(server.url, 'admin', 'admin')
+            reader.submit_machines(
+                [{'viewid': 1, 'patientid': 1, 'utc': 2,
+                  'mapping': mapping}], updatefunc=updatefunc)
+
+
+def soak(duration=60, rows=200, limit=None, filename=None, engine='openpyxl',
+         warmup=3, minrounds=8):
+    """Run rounds against the local stand-ins for duration seconds, and
+       for at least minrounds rounds after the warmup rounds. Returns the
+       resident memory (in bytes) after each round."""
+
+    server = StandInServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    monitor = memorymonitor.MemoryMonitor(limit=limit)
+    samples = []
+    start = time.time()
+    seed = 0
+    try:
+        while seed < warmup + minrounds or time.time() - start < duration:
+            run_round(server, monitor, seed, rows, filename, engine)
+            gc.collect()
+            samples.append(memorymonitor.get_rss())
+            logger.info("Round %d: %d submissions, RSS %s", seed + 1,
+                        server.posts, memorymonitor.format_size(samples[-1]))
+            seed += 1
+    finally:
+        server.shutdown()
+        server.server_close()
+    monitor.report()
+    return samples
+
+
+def get_growth(samples, warmup=3, minrounds=8):
+    """Return the growth (in bytes) of the resident memory between the
+       first and last quarter of the rounds after the warmup rounds.
+       Raises ValueError if fewer than minrounds rounds were sampled."""
+
+    samples = [s for s in samples[warmup:] if s is not None]
+    if len(samples) < max(4, minrounds):
+        raise ValueError("Only " + str(len(samples)) + " rounds were " +
+                         "sampled, at least " + str(max(4, minrounds)) +
+                         " are needed to measure the memory growth")
+    quarter = len(samples) // 4
+    first = sorted(samples[:quarter])[quarter // 2]
+    last = sorted(samples[-quarter:])[quarter // 2]
+    return last - first
+
+if __name__ == '__main__':
+
+    import sys
+    import argparse
+    import logging.handlers
+    logger = logging.getLogger('qatrackimport')
+    logger.setLevel(logging.INFO)
+    ch = logging.StreamHandler()
+    ch.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+    logger.addHandler(ch)
+
+    # Set up argparser to parse the command-line arguments
+    class DefaultParser(argparse.ArgumentParser):
+        def error(self, message):
+            sys.stderr.write('error: %s\n' % message)
+            self.print_help()
+            sys.exit(2)
+
+    parser = DefaultParser(
+        description="Repeatedly convert and submit synthetic test results " +
+        "to local stand-ins for QATrack+ and MosaiQ, and check that the " +
+        "resident memory does not grow.")
+    parser.add_argument("-t", "--duration",
+                        help="Number of seconds to run (default: 60)",
+                        type=int, default=60)
+    parser.add_argument("-r", "--rows",
+                        help="Number of CT Daily QA rows per round",
+                        type=int, default=200)
+    parser.add_argument("-l", "--limit",
+                        help="Memory limit in MB",
+                        type=int)
+    parser.add_argument("-g", "--growth",
+                        help="Allowed growth of the resident memory in MB " +
+                        "(default: 5)",
+                        type=float, default=5)
+    parser.add_argument("-m", "--minrounds",
+                        help="Minimum number of rounds to sample after " +
+                        "the warmup rounds (default: 8)",
+                        type=int, default=8)
+    parser.add_argument("-f", "--file",
+                        help="Excel (.xlsx) file to read in each round")
+    parser.add_argument("--engine",
+                        help="Excel reader engine (openpyxl or stream)",
+                        choices=['openpyxl', 'stream'], default='openpyxl')
+
+    args = parser.parse_args()
+
+    # Silence the per-row logging of the submitters during the soak test
+    for name in ['qatrackimport.ctdailyqasumbmitter',
+                 'qatrackimport.mqassessmentssubmitter',
+                 'qatrackimport.resultssubmitter']:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    started = datetime.datetime.now()
+    samples = soak(args.duration, args.rows, args.limit, args.file,
+                   args.engine, minrounds=args.minrounds)
+    try:
+        growth = get_growth(samples, minrounds=args.minrounds)
+    except ValueError as e:
+        logger.error(e)
+        sys.exit(1)
+    logger.info("Ran %d rounds in %s. Resident memory growth: %s",
+                len(samples), datetime.datetime.now() - started,
+                memorymonitor.format_size(growth))
+
+    # Exit with an error code so that a leak can fail a build
+    sys.exit(1 if growth > args.growth * 1048576 else 0)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# workbookcache.py
+"""Cache the cell values of a parsed Excel worksheet in a sidecar file."""
+# Copyright (c) 2015 Aditya Panchal
+
+import datetime
+import os
+import struct
+import hashlib
+import json
+import tempfile
+import zlib
+import logging
+logger = logging.getLogger('qatrackimport.workbookcache')
+
+# File signature and format version of the cache file
+magic = b'QTIC'
+version = 2
+
+# Tags of the date and time values, which JSON can't represent
+datetimetags = [('datetime', datetime.datetime, "%Y-%m-%dT%H:%M:%S.%f"),
+                ('date', datetime.date, "%Y-%m-%d"),
+                ('time', datetime.time, "%H:%M:%S.%f")]
+
+
+class WorksheetSnapshot(object):
+    """Class that holds the cell values of a worksheet by column."""
+    def __init__(self, columns, minrow=1):
+
+        self.columns = columns
+        self.minrow = minrow
+        self.max_row = minrow + len(columns[0]) - 1 if len(columns) else 0
+
+    def iter_rows(self, startrow, endrow):
+        """Iterate over the cell values of the selected rows."""
+
+        start = max(startrow, self.minrow) - self.minrow
+        end = min(endrow, self.max_row) - self.minrow + 1
+        for i in range(start, end):
+            yield [c[i] for c in self.columns]
+
+
+def get_cache_filename(filename):
+    """Return the name of the cache file for the given Excel file."""
+
+    return filename + '.cache'
+
+
+def get_file_hash(filename):
+    """Return the SHA-1 hash of the contents of the given file."""
+
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def encode_value(value):
+    """Encode a date or time cell value as a tagged JSON object."""
+
+    for tag, cls, fmt in datetimetags:
+        if isinstance(value, cls):
+            return {tag: value.strftime(fmt)}
+    raise TypeError("Unable to cache cell value: " + repr(value))
+
+
+def decode_value(obj):
+    """Decode a tagged JSON object created by encode_value."""
+
+    for tag, cls, fmt in datetimetags:
+        if tag in obj:
+            value = datetime.datetime.strptime(obj[tag], fmt)
+            if cls is datetime.date:
+                return value.date()
+            elif cls is datetime.time:
+                return value.time()
+            return value
+    raise ValueError("Unknown cell value: " + repr(obj))
+
+
+def replace_file(src, dst):
+    """Rename src to dst, replacing dst atomically where possible."""
+
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    elif os.name == 'nt':
+        # Python 2 can't rename over an existing file on Windows
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+    else:
+        os.rename(src, dst)
+
+
+def write_cache(cachefile, header, numcolumns, blobs):
+    """Write the header and the compressed columns to a temporary file and
+       replace the cache file with it, so that processes writing the same
+       cache file at once don't corrupt it. Returns False if the cache
+       file could not be written."""
+
+    header = json.dumps(header).encode('utf-8')
+    fd, tmpfile = tempfile.mkstemp(
+        prefix=os.path.basename(cachefile) + '.',
+        dir=os.path.dirname(os.path.abspath(cachefile)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(magic + struct.pack('<HII', version, len(header),
+                                        numcolumns))
+            f.write(header)
+            for data in blobs:
+                f.write(struct.pack('<I', len(data)))
+                f.write(data)
+        replace_file(tmpfile, cachefile)
+    except (IOError, OSError) as e:
+        logger.warning("Unable to write cache file %s: %s", cachefile, e)
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        return False
+    logger.debug("Saved cache file: %s", cachefile)
+    return True
+
+
+def save(filename, rows, minrow=1):
+    """Save the cell values of the given rows to the cache file of the
+       Excel file. Returns the WorksheetSnapshot of the rows."""
+
+    # Transpose the rows so that each column is stored contiguously
+    columns = [list(c) for c in zip(*rows)]
+    snapshot = WorksheetSnapshot(columns, minrow)
+
+    stat = os.stat(filename)
+    header = {
+        'path': os.path.abspath(filename),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'sha1': get_file_hash(filename),
+        'minrow': minrow}
+
+    # Only data is stored so that loading the cache can't run code
+    write_cache(get_cache_filename(filename), header, len(columns),
+                (zlib.compress(json.dumps(
+                    c, default=encode_value).encode('utf-8'))
+                 for c in columns))
+
+    return snapshot
+
+
+def load(filename):
+    """Load the WorksheetSnapshot of the given Excel file from its cache
+       file. Returns None if there is no valid cache file."""
+
+    cachefile = get_cache_filename(filename)
+    if not os.path.exists(cachefile):
+        return None
+
+    try:
+        with open(cachefile, 'rb') as f:
+            sig = f.read(4)
+            ver, headerlen, numcolumns = struct.unpack('<HII', f.read(10))
+            if sig != magic or ver != version:
+                logger.debug("Invalid cache file format: %s", cachefile)
+                return None
+            header = json.loads(f.read(headerlen).decode('utf-8'))
+
+            # Check if the Excel file has changed since it was cached.
+            # Only hash the file if the size matches but the mtime differs
+            stat = os.stat(filename)
+            if header['path'] != os.path.abspath(filename) or \
+                    header['size'] != stat.st_size:
+                logger.debug("Cache file is out of date: %s", cachefile)
+                return None
+            touched = header['mtime'] != stat.st_mtime
+            if touched and header['sha1'] != get_file_hash(filename):
+                logger.debug("Cache file is out of date: %s", cachefile)
+                return None
+
+            columns = []
+            blobs = []
+            for n in range(numcolumns):
+                datalen = struct.unpack('<I', f.read(4))[0]
+                data = f.read(datalen)
+                columns.append(json.loads(
+                    zlib.decompress(data).decode('utf-8'),
+                    object_hook=decode_value))
+                if touched:
+                    blobs.append(data)
+    except (IOError, OSError, ValueError, KeyError, struct.error,
+            zlib.error) as e:
+        logger.info("Unable to read cache file %s: %s", cachefile, e)
+        return None
+
+    # The Excel file was only touched, so store its new mtime to avoid
+    # hashing it again the next time the cache file is loaded
+    if touched:
+        header['mtime'] = stat.st_mtime
+        write_cache(cachefile, header, numcolumns, blobs)
+
+    logger.debug("Loaded cache file: %s", cachefile)
+    return WorksheetSnapshot(columns, header['minrow'])
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# xlsxreader.py
+"""Stream the cell values of the active worksheet of an Excel file."""
+# Copyright (c) 2015 Aditya Panchal
+
+import datetime
+import posixpath
+import re
+import zipfile
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+import logging
+logger = logging.getLogger('qatrackimport.xlsxreader')
+
+ns = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+relns = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+pkgns = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+# Built-in number formats that openpyxl reads as dates or times
+date_formats = set(list(range(14, 23)) + [45, 47])
+cellref = re.compile(r'^([A-Z]+)(\d+)$')
+
+
+def column_index(letters):
+    """Return the 1-based column index of the column letters."""
+
+    index = 0
+    for c in letters:
+        index = index * 26 + ord(c) - 64
+    return index
+
+
+def is_date_format(fmt):
+    """Return True if the custom number format code is a date format, using
+       the same rule as openpyxl."""
+
+    fmt = fmt.lower()
+    # Date characters are ignored if quoted or in brackets (i.e. "[hh]")
+    return re.search(r'[dmyhs]', fmt) is not None and \
+        re.search(r'((?<=\[)|").*[dmhys]+.*(\]|")', fmt) is None
+
+
+class XLSXStreamReader(object):
+    """Class that reads the cell values of the active worksheet of an
+       Excel (.xlsx) file by streaming the sheet XML. Only the columns
+       from mincol to maxcol are read and shared strings are loaded when
+       they are first needed."""
+    def __init__(self, filename, mincol=2, maxcol=31):
+
+        self.archive = zipfile.ZipFile(filename)
+        self.mincol = mincol
+        self.maxcol = maxcol
+        self.strings = None
+
+        # Find the path of the active sheet and the date system
+        wb = ElementTree.fromstring(self.archive.read('xl/workbook.xml'))
+        pr = wb.find(ns + 'workbookPr')
+        self.epoch = datetime.datetime(1904, 1, 1) \
+            if pr is not None and pr.get('date1904') in ('1', 'true') \
+            else datetime.datetime(1899, 12, 30)
+        view = wb.find(ns + 'bookViews/' + ns + 'workbookView')
+        active = int(view.get('activeTab', 0)) if view is not None else 0
+        sheet = wb.findall(ns + 'sheets/' + ns + 'sheet')[active]
+        rels = ElementTree.fromstring(
+            self.archive.read('xl/_rels/workbook.xml.rels'))
+        target = [r.get('Target')
+                  for r in rels.findall(pkgns + 'Relationship')
+                  if r.get('Id') == sheet.get(relns + 'id')][0]
+        self.sheetpath = target.lstrip('/') if target.startswith('/') \
+            else posixpath.join('xl', target)
+
+        self.read_styles()
+        self.max_row = self.read_dimension()
+
+    def read_styles(self):
+        """Determine which cell styles have a date number format."""
+
+        self.datestyles = set()
+        if 'xl/styles.xml' not in self.archive.namelist():
+            return
+        styles = ElementTree.fromstring(self.archive.read('xl/styles.xml'))
+        custom = set(int(f.get('numFmtId')) for f in styles.findall(
+            ns + 'numFmts/' + ns + 'numFmt') if is_date_format(
+            f.get('formatCode', '')))
+        xfs = styles.findall(ns + 'cellXfs/' + ns + 'xf')
+        for n, xf in enumerate(xfs):
+            fmt = int(xf.get('numFmtId', 0))
+            if fmt in date_formats or fmt in custom:
+                self.datestyles.add(n)
+
+    def read_dimension(self):
+        """Return the last row of the sheet from its dimension element,
+           or by reading all rows if the sheet has no dimension."""
+
+        with self.archive.open(self.sheetpath) as f:
+            for event, elem in ElementTree.iterparse(f, ('start',)):
+                if elem.tag == ns + 'dimension':
+                    m = cellref.match(elem.get('ref').split(':')[-1])
+                    if m is not None:
+                        return int(m.group(2))
+                if elem.tag == ns + 'sheetData':
+                    break
+        maxrow = 0
+        for rownum, values in self.iter_sheet():
+            maxrow = rownum
+        return maxrow
+
+    def get_shared_strings(self):
+        """Load the shared strings table when it is first needed."""
+
+        if self.strings is None:
+            self.strings = []
+            if 'xl/sharedStrings.xml' in self.archive.namelist():
+                with self.archive.open('xl/sharedStrings.xml') as f:
+                    sst = None
+                    for event, elem in ElementTree.iterparse(
+                            f, ('start', 'end')):
+                        if event == 'start':
+                            if sst is None:
+                                sst = elem
+                            continue
+                        if elem.tag == ns + 'si':
+                            # Rich text is split into several runs
+                            self.strings.append(''.join(
+                                t.text or '' for t in elem.iter(ns + 't')))
+                            # Remove the string so the tree doesn't grow
+                            sst.remove(elem)
+        return self.strings
+
+    def convert_date(self, serial):
+        """Convert a date serial number to a datetime the same way as
+           openpyxl. Serial numbers without a date are returned as a time."""
+
+        # Excel incorrectly treats 1900 as a leap year
+        if self.epoch.year == 1899 and 1 < serial < 60:
+            serial += 1
+        day, fraction = divmod(serial, 1)
+        diff = datetime.timedelta(days=fraction)
+        if 0 < abs(serial) < 1:
+            return (datetime.datetime.min + diff).time()
+        return self.epoch + datetime.timedelta(days=day) + diff
+
+    def convert_value(self, celltype, value, style):
+        """Convert the text of a cell to its Python value."""
+
+        if celltype == 's':
+            return self.get_shared_strings()[int(value)]
+        elif celltype == 'b':
+            return value == '1'
+        elif celltype in ('str', 'inlineStr', 'e'):
+            return value
+        elif style in self.datestyles:
+            return self.convert_date(float(value))
+        elif '.' in value or 'E' in value or 'e' in value:
+            return float(value)
+        return int(value)
+
+    def iter_sheet(self, startrow=None, endrow=None):
+        """Iterate over the row number and cell values of the rows of the
+           sheet that contain cells, from startrow and stopping after
+           endrow. The cells of earlier rows are not converted."""
+
+        ncols = self.maxcol - self.mincol + 1
+        rowtag, vtag, istag = ns + 'row', ns + 'v', ns + 'is'
+        sheetdatatag = ns + 'sheetData'
+        datestyles = set(str(s) for s in self.datestyles)
+        # Column letters of the cell references and their value index
+        columns = {}
+        rownum = 0
+        sheetdata = None
+        with self.archive.open(self.sheetpath) as f:
+            for event, elem in ElementTree.iterparse(f, ('start', 'end')):
+                if event == 'start':
+                    if elem.tag == sheetdatatag:
+                        sheetdata = elem
+                    continue
+                if elem.tag != rowtag:
+                    continue
+                rownum = int(elem.get('r', rownum + 1))
+                if endrow is not None and rownum > endrow:
+                    break
+                if startrow is not None and rownum < startrow:
+                    if sheetdata is not None:
+                        sheetdata.remove(elem)
+                    else:
+                        elem.clear()
+                    continue
+                values = [None] * ncols
+                col = self.mincol - 1
+                for c in elem:
+                    ref = c.get('r')
+                    if ref is not None:
+                        letters = ref.rstrip('0123456789')
+                        col = columns.get(letters)
+                        if col is None:
+                            col = columns[letters] = \
+                                column_index(letters) - self.mincol
+                    else:
+                        col += 1
+                    if col < 0 or col >= ncols:
+                        continue
+                    celltype = c.get('t')
+                    if celltype == 'inlineStr':
+                        v = c.find(istag)
+                        if v is not None:
+                            values[col] = ''.join(
+                                t.text or '' for t in v.iter(ns + 't'))
+                        continue
+                    v = c.find(vtag)
+                    if v is None or v.text is None:
+                        continue
+                    if celltype in (None, 'n') and \
+                            c.get('s') not in datestyles:
+                        # Plain numbers are by far the most common cells
+                        value = v.text
+                        values[col] = float(value) if '.' in value or \
+                            'E' in value or 'e' in value else int(value)
+                    else:
+                        values[col] = self.convert_value(
+                            celltype, v.text, int(c.get('s', 0)))
+                # Remove the row so that the tree doesn't grow with the sheet
+                if sheetdata is not None:
+                    sheetdata.remove(elem)
+                else:
+                    elem.clear()
+                yield rownum, values
+
+    def iter_rows(self, startrow, endrow):
+        """Iterate over the cell values of the selected rows. Rows without
+           cells are returned as a list of None values."""
+
+        ncols = self.maxcol - self.mincol + 1
+        nextrow = startrow
+        for rownum, values in self.iter_sheet(startrow, endrow):
+            while nextrow < rownum:
+                yield [None] * ncols
+                nextrow += 1
+            yield values
+            nextrow = rownum + 1
+        while nextrow <= endrow:
+            yield [None] * ncols
+            nextrow += 1
+
+    def close(self):
+        """Close the Excel file."""
+
+        self.archive.close()
+
+
+def verify(filename, startrow=1, endrow=None):
+    """Compare the rows read by XLSXStreamReader and openpyxl. Returns a
+       list of the row numbers that differ."""
+
+    import openpyxl
+
+    wb = openpyxl.load_workbook(filename=filename, use_iterators=True,
+                                data_only=True)
+    ws = wb.get_active_sheet()
+    endrow = ws.max_row if endrow is None else endrow
+    reader = XLSXStreamReader(filename)
+    expected = ([x.value for x in row] for row in ws.iter_rows(
+        'B' + str(startrow) + ':AE' + str(endrow)))
+    different = []
+    for rownum, (a, b) in enumerate(
+            zip(expected, reader.iter_rows(startrow, endrow)), startrow):
+        if a != b:
+            logger.info("Row %d differs:\n  openpyxl: %s\n  stream:   %s",
+                        rownum, a, b)
+            different.append(rownum)
+    reader.close()
+    return different
+
+if __name__ == '__main__':
+
+    import sys
+    import argparse
+    import time
+    import logging.handlers
+    logger = logging.getLogger('qatrackimport')
+    logger.setLevel(logging.INFO)
+    ch = logging.StreamHandler()
+    ch.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+    logger.addHandler(ch)
+
+    # Set up argparser to parse the command-line arguments
+    class DefaultParser(argparse.ArgumentParser):
+        def error(self, message):
+            sys.stderr.write('error: %s\n' % message)
+            self.print_help()
+            sys.exit(2)
+
+    parser = DefaultParser(
+        description="Verify that the streaming Excel reader returns the " +
+        "same values as openpyxl for an Excel (.xlsx) file.")
+    parser.add_argument("filename",
+                        help="Excel (.xlsx) file name")
+
+    # If there are no arguments, display help and exit
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+    args = parser.parse_args()
+
+    different = verify(args.filename)
+    logger.info("%d rows differ", len(different))
+
+    # Compare the time taken to read all rows with each engine
+    import ctdailyqasubmitter
+    for engine in ['openpyxl', 'stream']:
+        start = time.time()
+        reader = ctdailyqasubmitter.CTDailyQASubmitter(args.filename)
+        reader.read_excel_file(engine=engine)
+        for row in reader.iter_rows(1, reader.max_row):
+            pass
+        logger.info("%s: %.3f s", engine, time.time() - start)
+
+    sys.exit(1 if len(different) else 0)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# test_xlsxreader.py
+"""Check that the streaming Excel reader returns the same values as
+   openpyxl."""
+# Copyright (c) 2015 Aditya Panchal
+
+import datetime
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'qatrackimport'))
+import openpyxl
+import xlsxreader
+
+
+def make_workbook(filename, numrows=300, seed=0):
+    """Create a CT Daily QA like workbook with dates, times, numbers,
+       strings, booleans and empty rows."""
+
+    r = random.Random(seed)
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    for i in range(1, numrows + 1):
+        # Leave some rows empty
+        if i % 37 == 0:
+            continue
+        cell = ws.cell(row=i, column=2)
+        # Dates before March 1900 are shifted by the 1900 leap year bug
+        cell.value = r.choice([i, i + 0.25, 40000 + i, 40000.4375 + i])
+        cell.number_format = r.choice(['yyyy-mm-dd', 'yyyy-mm-dd h:mm'])
+        ws.cell(row=i, column=3).value = r.choice(["AP", "No sims", None])
+        for c in range(4, 23):
+            ws.cell(row=i, column=c).value = r.choice(
+                [None, 1, 2.5, -0.25, 1e-7, 12345678901])
+        # Times without a date
+        cell = ws.cell(row=i, column=23)
+        cell.value = r.choice([0.4375, 0.75, 0.999988])
+        cell.number_format = r.choice(['h:mm', 'h:mm:ss', 'mm:ss'])
+        # Number formats that only look like dates
+        cell = ws.cell(row=i, column=24)
+        cell.value = r.choice([1.5, 2])
+        cell.number_format = r.choice(['0.00"s"', '[h]:mm:ss', '0.0'])
+        ws.cell(row=i, column=25).value = r.choice([True, False, None])
+        for c in (28, 29, 30):
+            ws.cell(row=i, column=c).value = r.choice(['X', 'x', None])
+        ws.cell(row=i, column=31).value = r.choice(
+            [u"Comment & <stuff> °", None])
+        # Columns outside of B to AE are not read
+        ws.cell(row=i, column=33).value = "outside"
+    wb.save(filename)
+
+
+class TestXLSXStreamReader(unittest.TestCase):
+    """Compare the values read by XLSXStreamReader and openpyxl."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tempdir = tempfile.mkdtemp()
+        cls.filename = os.path.join(cls.tempdir, 'ct.xlsx')
+        make_workbook(cls.filename)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tempdir)
+
+    def test_all_rows(self):
+        self.assertEqual(xlsxreader.verify(self.filename), [])
+
+    def test_row_range(self):
+        self.assertEqual(xlsxreader.verify(self.filename, 100, 150), [])
+
+    def test_max_row(self):
+        reader = xlsxreader.XLSXStreamReader(self.filename)
+        self.assertEqual(reader.max_row, 300)
+        reader.close()
+
+    def test_time_values(self):
+        reader = xlsxreader.XLSXStreamReader(self.filename)
+        values = [row[21] for row in reader.iter_rows(1, 10)]
+        reader.close()
+        self.assertTrue(all(isinstance(v, datetime.time)
+                            for v in values if v is not None))
+
+if __name__ == '__main__':
+    unittest.main()